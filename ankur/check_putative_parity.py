@@ -0,0 +1,155 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from putative import PutativeSaccadesEnrichment
+
+# Regression check for PutativeSaccadesEnrichment on synthetic eye positions, no NWB needed
+# - _correct_eye_position and _interpolate_dropped_frames match the original per-frame loops, and how much faster they are
+# - the chunked (chunk_size) mode gives the same outputs as running on the whole arrays
+# Run from the ankur folder with 'python check_putative_parity.py', exits with 1 if anything doesn't match
+
+
+def old_correct_eye_position(x, y, timestamps):
+    # Original per-timestamp loop from before _correct_eye_position was vectorized
+    corrected = np.full([x.shape[0] + int(1e6), 2], np.nan)
+    factor = np.median(timestamps)
+
+    frame_offset = 0
+    frame_idx = 0
+    for frame in timestamps:
+        frame_offset = frame_offset + (round(frame / factor) - 1)  # Increment frame
+        if frame_idx < x.shape[0]:
+            corrected[frame_idx + frame_offset] = np.array([x[frame_idx], y[frame_idx]])
+        frame_idx = frame_idx + 1
+
+    return corrected[:frame_idx + frame_offset, :]
+
+
+def old_interpolate_dropped_frames(corrected, max_dropped_frames=PutativeSaccadesEnrichment.MAX_DROPPED_FRAMES):
+    # Original window scanning loop, with each column filled using its own windows (the original only applied the
+    # windows of the last column, fixed along with the vectorization) and runs at the very start left as NaN
+    interpolated = np.copy(corrected)
+    for col_idx in [0, 1]:
+        to_interpl = interpolated[:, col_idx]
+        dropped = np.isnan(to_interpl)
+        windows = []
+
+        row_idx = 0
+        while row_idx < dropped.size:
+            if not dropped[row_idx]:
+                row_idx = row_idx + 1
+                continue
+            num_dropped = 0
+            for rdropped in dropped[row_idx:]:  # Go over until we find a frame that wasn't dropped
+                if not rdropped:
+                    break
+                num_dropped = num_dropped + 1
+            if num_dropped <= max_dropped_frames and row_idx > 0 and row_idx + num_dropped + 1 < to_interpl.size:
+                windows.append([row_idx - 1, row_idx + num_dropped + 1])
+            row_idx = row_idx + num_dropped
+
+        for start, stop in windows:
+            xframes = np.arange(start + 1, stop - 1, 1)
+            xvals = np.array([start, stop - 1])
+            yvals = np.array([to_interpl[start], to_interpl[stop - 1]])
+            interpolated[start + 1: stop - 1, col_idx] = np.interp(xframes, xvals, yvals)
+
+    return interpolated
+
+
+def synthetic_session(num_frames, seed=0):
+    # Eye positions with slow drift, jumps that look like saccades, low likelihood frames and dropped frame intervals
+    rng = np.random.default_rng(seed)
+    x = 300 + 20 * np.sin(np.cumsum(rng.normal(0, 1, num_frames)) / 50) + rng.normal(0, .3, num_frames)
+    x = x + np.cumsum(np.where(rng.random(num_frames) < .002, rng.normal(0, 10, num_frames), 0))
+    y = 200 + 0.1 * x + 5 * np.sin(np.cumsum(rng.normal(0, 1, num_frames)) / 80) + rng.normal(0, .3, num_frames)
+    likelihood = np.where(rng.random(num_frames) < 0.03, 0.5, 1.0)
+    timestamps = np.full(num_frames, 6666.0)  # Interval since the last frame
+    dropped_idxs = rng.integers(1, num_frames, num_frames // 1000)
+    timestamps[dropped_idxs] = timestamps[dropped_idxs] * rng.integers(2, 8, dropped_idxs.size)
+    return {"x": x, "y": y, "likelihood": likelihood, "timestamps": timestamps}
+
+
+def create_enrichment(data, chunk_size=None):
+    # Enrichment that reads from data instead of an NWB and keeps what it would save
+    enrichment = PutativeSaccadesEnrichment(fps=150, chunk_size=chunk_size)
+    enrichment.saved = {}
+    enrichment._get_req_val = lambda key, nwb: data[key]
+    enrichment._save_val = lambda key, val, nwb: enrichment.saved.__setitem__(key, np.array(val))
+    return enrichment
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, matched, detail=""):
+    print(f"{'OK  ' if matched else 'FAIL'} {name} {detail}")
+    return matched
+
+
+def check_loops(data):
+    enrichment = create_enrichment(data)
+    x = np.where(data["likelihood"] < enrichment.likelihood_threshold, np.nan, data["x"])
+    y = np.where(data["likelihood"] < enrichment.likelihood_threshold, np.nan, data["y"])
+    results = []
+
+    # Also with fewer positions than timestamps, those frames are left as NaN
+    for name, num_positions in [("all positions", x.size), ("missing positions", x.size - 100)]:
+        old, old_seconds = timed(old_correct_eye_position, x[:num_positions], y[:num_positions], data["timestamps"])
+        new, new_seconds = timed(enrichment._correct_eye_position, x[:num_positions], y[:num_positions], data["timestamps"])
+        matched = old.shape == new.shape and np.array_equal(old, new, equal_nan=True)
+        results.append(report(f"_correct_eye_position, {name}", matched, f"old {old_seconds:.3f}s new {new_seconds:.3f}s"))
+
+    corrected = enrichment._correct_eye_position(x, y, data["timestamps"])
+    old, old_seconds = timed(old_interpolate_dropped_frames, corrected)
+    new, new_seconds = timed(enrichment._interpolate_dropped_frames, corrected)
+    matched = np.allclose(old, new, equal_nan=True, rtol=0, atol=1e-9)
+    results.append(report("_interpolate_dropped_frames", matched, f"old {old_seconds:.3f}s new {new_seconds:.3f}s"))
+    return all(results)
+
+
+def check_chunked(data, chunk_sizes):
+    whole = create_enrichment(data)
+    _, whole_seconds = timed(whole._run, None)
+    results = []
+
+    for chunk_size in chunk_sizes:
+        chunked = create_enrichment(data, chunk_size)
+        _, chunked_seconds = timed(chunked._run, None)
+        print(f"chunk_size={chunk_size} whole {whole_seconds:.2f}s chunked {chunked_seconds:.2f}s")
+        for key, expected in whole.saved.items():
+            actual = chunked.saved[key]
+            matched = expected.shape == actual.shape and np.allclose(expected, actual, equal_nan=True, atol=1e-8)
+            results.append(report(f"  {key}", matched, str(expected.shape)))
+    return all(results)
+
+
+def main(num_frames, chunk_sizes):
+    data = synthetic_session(num_frames)
+    print(f"Checking against {num_frames} synthetic frames\n")
+    loops_matched = check_loops(data)
+    print("")
+    chunked_matched = check_chunked(data, chunk_sizes)
+
+    print("\nSummary \n ------")
+    print(f"Original loops: {'match' if loops_matched else 'MISMATCH'}")
+    print(f"Chunked mode: {'matches' if chunked_matched else 'MISMATCH'}")
+    return loops_matched and chunked_matched
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        prog="check_putative_parity.py",
+        description="Checks PutativeSaccadesEnrichment against the original loops and its chunked mode on synthetic data"
+    )
+    arg_parser.add_argument("-n", "--frames", type=int, default=300000, help="Number of synthetic frames")
+    arg_parser.add_argument("-c", "--chunk-sizes", type=int, nargs="+", default=[997, 50000], help="chunk_size values to compare against the whole array run")
+    args = arg_parser.parse_args()
+
+    sys.exit(0 if main(args.frames, args.chunk_sizes) else 1)
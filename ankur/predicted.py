@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 
 from simply_nwb.pipeline.util import resample_interp
@@ -59,6 +61,7 @@ class PredictSaccadesEnrichment(Enrichment):
     def preformat_waveforms(waveforms: np.ndarray, num_features=30, single_dim=False):
         # Helper func to format the waveforms as velocities, sampled, with no NaNs
         # Expects waveforms to be a (N, t, 2) arr where N is the number of samples, t is the time length, and 2 is x,y
+        waveforms = np.asarray(waveforms)
         if single_dim:
             waveforms = waveforms[:, :, None]
             waveforms = np.pad(waveforms, ((0, 0), (0, 0), (0, 1)), constant_values=-1)
@@ -66,18 +69,14 @@ class PredictSaccadesEnrichment(Enrichment):
 
         wav_x = waveforms[:, :, 0]
         wav_y = waveforms[:, :, 1]
-        x_velocities = []
-        idxs = []
-
-        for idx in range(wav_x.shape[0]):
-            is_x_non_nan = np.all(np.invert(np.isnan(wav_x[idx])))
-            is_y_non_nan = np.all(np.invert(np.isnan(wav_y[idx])))
-            if is_x_non_nan and is_y_non_nan:  # Both entries are non-nan
-                # Forward difference (discrete derivative/velocity)
-                # Resample to match the number of 'features'
-                resampd = PredictSaccadesEnrichment._resample_waveform_to_velocity(wav_x[idx], num_features)
-                x_velocities.append(resampd)
-                idxs.append(idx)
+
+        # Only use waveforms where both the x and y entries are non-nan
+        idxs = np.where(np.invert(np.isnan(wav_x).any(axis=1) | np.isnan(wav_y).any(axis=1)))[0]
+
+        # Forward difference (discrete derivative/velocity) of every waveform at once
+        # Resample to match the number of 'features', resampling is linear so all rows are done with one matmul
+        velocities = np.diff(wav_x[idxs], axis=1)
+        x_velocities = velocities @ PredictSaccadesEnrichment._resample_weights(wav_x.shape[1], num_features)
 
         """
         y == 0 -> waveform is noise
@@ -91,7 +90,17 @@ class PredictSaccadesEnrichment(Enrichment):
                                  |
                                   ----
         """
-        return np.array(x_velocities), np.array(idxs)
+        return x_velocities, idxs
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _resample_weights(waveform_length: int, sampling_size=30):
+        # (waveform_length - 1, sampling_size) matrix that does _resample_waveform_to_velocity's resampling as a matmul.
+        # Row i is the resampled ith unit vector, so any velocity @ weights is the same as resampling that velocity
+        basis = np.eye(waveform_length - 1)
+        weights = np.array([resample_interp(row, sampling_size)[1] for row in basis])
+        weights.setflags(write=False)  # Shared between calls, don't let anyone modify it
+        return weights
 
     @staticmethod
     def _resample_waveform_to_velocity(single_waveform: np.ndarray, sampling_size=30):
@@ -100,8 +109,9 @@ class PredictSaccadesEnrichment(Enrichment):
         return resampd
 
     def _run(self, pynwb_obj):
-        pred_labels, pred_waveforms, pred_sacc_indices = self._predict_saccade_direction(pynwb_obj)
-        self._predict_saccade_epochs(pynwb_obj, pred_labels, pred_waveforms, pred_sacc_indices)
+        # Features are computed once here and indexed into by the epoch stage, rows line up with pred_waveforms
+        pred_labels, pred_waveforms, pred_sacc_indices, pred_features = self._predict_saccade_direction(pynwb_obj)
+        self._predict_saccade_epochs(pynwb_obj, pred_labels, pred_waveforms, pred_sacc_indices, pred_features)
 
     def _predict_saccade_direction(self, pynwb_obj):
         self.logger.info("Predicting saccade waveform labels (direction)..")
@@ -111,7 +121,7 @@ class PredictSaccadesEnrichment(Enrichment):
         # Format the waveforms by getting velocities, also get the indexes of the waveforms that are used
         x_velocities, idxs = self.preformat_waveforms(waveforms)
 
-        # Reindex to only include the waveforms that were formatted from above
+        # Reindex to only include the waveforms that were formatted from above, so they line up with x_velocities
         waveforms = waveforms[idxs]
         indices = indices[idxs]
 
@@ -119,9 +129,9 @@ class PredictSaccadesEnrichment(Enrichment):
         # pred_labels = self._direction_cls.predict(x_velocities)
         pred_labels = self._direction_cls.predict(waveforms[:, :, 0])  # TODO use velocities instead?
 
-        return pred_labels, waveforms, indices
+        return pred_labels, waveforms, indices, x_velocities
 
-    def _predict_saccade_epochs(self, pynwb_obj, pred_labels, pred_waveforms, pred_sacc_indices):
+    def _predict_saccade_epochs(self, pynwb_obj, pred_labels, pred_waveforms, pred_sacc_indices, pred_features):
         self.logger.info("Predicting saccade epochs..")
 
         # X = x value, velocity and resampled
@@ -141,16 +151,15 @@ class PredictSaccadesEnrichment(Enrichment):
                 (self._nasal_epoch_regressor, self._nasal_epoch_transformer, 1, "nasal")]:
 
             dir_idxs = np.where(pred_labels == saccade_direction)[0]
-            resamp, nonnan_idxs = self.preformat_waveforms(pred_waveforms[dir_idxs])
-            assert len(nonnan_idxs) == dir_idxs.shape[0], "Epoch waveform formatting changed array size, additional NaN values were detected between direction prediction and epoch prediction, will not line up!! (this shouldn't happen!)"
+            resamp = pred_features[dir_idxs]  # Already formatted in the direction stage, every row is non-nan
 
             reg_pred = regressor.predict(resamp)
             pred = transformer.inverse_transform(reg_pred)
             # Broadcast the indices so we can add them to the predicted relative offsets easily
-            reshaped_sacc_indices = np.broadcast_to(pred_sacc_indices[dir_idxs][nonnan_idxs].reshape(-1, 1), (*pred_sacc_indices[dir_idxs][nonnan_idxs].shape, 2))
+            reshaped_sacc_indices = np.broadcast_to(pred_sacc_indices[dir_idxs].reshape(-1, 1), (*pred_sacc_indices[dir_idxs].shape, 2))
             up_pred = pred * sacc_fps + reshaped_sacc_indices  # Convert from seconds to frames using the fps
 
-            self._save_val(f"saccades_predicted_{name}_waveforms", pred_waveforms[dir_idxs][nonnan_idxs], pynwb_obj)
+            self._save_val(f"saccades_predicted_{name}_waveforms", pred_waveforms[dir_idxs], pynwb_obj)
             self._save_val(f"saccades_predicted_{name}_epochs", up_pred, pynwb_obj)
             self._save_val(f"saccades_predicted_{name}_peak_indices", pred_sacc_indices[dir_idxs], pynwb_obj)
 
@@ -1,16 +1,19 @@
+import hashlib
 import logging
+import os
+import tempfile
+import uuid
 from typing import Any
 
 import numpy as np
 import pandas as pd
-import scipy.stats
+import scipy.ndimage
+import scipy.signal
+import scipy.special
 from pynwb import NWBFile, TimeSeries
-from sklearn.decomposition import PCA
-from sklearn.impute import SimpleImputer
 
 from simply_nwb import SimpleNWB
 from simply_nwb.pipeline import Enrichment
-from simply_nwb.pipeline.util import interpolate_flat_arr, smooth_flat_arr
 from simply_nwb.pipeline.util.saccade_gui.consts import PERISACCADIC_WINDOW_IN_SECONDS
 from simply_nwb.pipeline.value_mapping import NWBValueMapping
 from simply_nwb.transforms import csv_load_dataframe_str
@@ -21,27 +24,103 @@ Code adapted from https://github.com/jbhunt/myphdlib/blob/5c5fe627507046e888eabc
 """
 
 
+class StageCache(object):
+    # Bump when a stage's implementation changes so old cached outputs aren't reused
+    VERSION = 2
+
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 2 ** 30):
+        """
+        On-disk cache of pipeline stage outputs, keyed by a hash of the stage's inputs and parameters
+
+        :param cache_dir: Directory to store the cached outputs in, will be created if it doesn't exist
+        :param max_bytes: Total size of the cache, least recently used outputs are deleted once this is exceeded
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, stage_name: str, inputs: list[np.ndarray], params: dict[str, Any]) -> str:
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(f"{stage_name}-{self.VERSION}-{sorted(params.items())}".encode("utf-8"))
+        for arr in inputs:
+            arr = np.ascontiguousarray(arr)
+            hasher.update(f"{arr.dtype.str}{arr.shape}".encode("utf-8"))
+            hasher.update(arr.data)
+        return f"{stage_name}-{hasher.hexdigest()}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key: str):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as loaded:
+            outputs = tuple(loaded[f"arr_{i}"] for i in range(len(loaded.files) - 1))
+            is_tuple = bool(loaded["is_tuple"])
+        os.utime(path)  # Mark as recently used
+        return outputs if is_tuple else outputs[0]
+
+    def put(self, key: str, outputs):
+        is_tuple = isinstance(outputs, tuple)
+        arrays = outputs if is_tuple else (outputs,)
+        # Write to a temp file then rename, so a crash or another process never sees a partial file
+        tmp_path = os.path.join(self.cache_dir, f"{uuid.uuid4()}.tmp.npz")
+        np.savez(tmp_path, *arrays, is_tuple=is_tuple)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz") and not entry.name.endswith(".tmp.npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum([e[1] for e in entries])
+        for _, size, path in sorted(entries):  # Oldest used first
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Already evicted by another process
+            total = total - size
+
+
 class PutativeSaccadesEnrichment(Enrichment):
-    def __init__(self, stim_name="RightCamStim", timestamp_name="rightCamTimestamps", likelihood_threshold=0.99, fps=150, x_center="pupilCenter_x", y_center="pupilCenter_y", likelihood="pupilCenter_likelihood"):
+    MAX_DROPPED_FRAMES = 4  # Longest run of dropped frames that gets interpolated over
+
+    def __init__(self, stim_name="RightCamStim", timestamp_name="rightCamTimestamps", likelihood_threshold=0.99, fps=150, x_center="pupilCenter_x", y_center="pupilCenter_y", likelihood="pupilCenter_likelihood", amplitude_threshold=0.99, min_inter_peak_interval=0.075, cache_dir=None, cache_max_bytes=10 * 2 ** 30, chunk_size=None, chunk_dir=None):
         """
         Create a new PutativeSaccadesEnrichment
 
         :param stim_name: Name of the stimulus, defaults to RightCamStim
         :param likelihood_threshold: threshold to use for the likelihood for eye positions
         :param fps: frames per second of the video used, defaults to 200
+        :param amplitude_threshold: percentile (0-1) of the velocity a peak must be above to be a putative saccade
+        :param min_inter_peak_interval: minimum time between saccade peaks, in seconds
+        :param cache_dir: if set, directory to cache each stage's output in so re-runs only recompute changed stages
+        :param cache_max_bytes: max total size of the stage cache, defaults to 10GB
+        :param chunk_size: if set, process the session this many frames at a time with disk backed arrays, for recordings that don't fit in memory
+        :param chunk_dir: directory for the disk backed arrays used when chunk_size is set, defaults to the system temp dir
         """
 
         # Give the superclass a mapping of required values for this enrichment to run
         super().__init__(NWBValueMapping({
-            "x": [lambda x: x.processing, stim_name, x_center, lambda y: y.data[:]],
-            "y": [lambda x: x.processing, stim_name, y_center, lambda y: y.data[:]],
-            "likelihood": [lambda x: x.processing, stim_name, likelihood, lambda y: y.data[:]],
+            "x": [lambda x: x.processing, stim_name, x_center, lambda y: y.data],
+            "y": [lambda x: x.processing, stim_name, y_center, lambda y: y.data],
+            "likelihood": [lambda x: x.processing, stim_name, likelihood, lambda y: y.data],
             "timestamps": [lambda x: x.stimulus, timestamp_name, lambda y: y.data[:]]
         }))  # TODO save the args as metadata
 
         self._stim_name = stim_name
         self.likelihood_threshold = likelihood_threshold
         self.fps = fps
+        self.amplitude_threshold = amplitude_threshold
+        self.min_inter_peak_interval = min_inter_peak_interval
+        self._cache = None if cache_dir is None else StageCache(cache_dir, cache_max_bytes)
+        self.chunk_size = chunk_size
+        self._chunk_dir = chunk_dir or tempfile.gettempdir()
 
     @staticmethod
     def from_raw(
@@ -154,11 +233,23 @@ class PutativeSaccadesEnrichment(Enrichment):
         :param pynwb_obj: NWB object to enrich
         """
 
+        if self.chunk_size is not None:
+            saved = self._run_chunked(pynwb_obj)
+        else:
+            saved = self._run_whole(pynwb_obj)
+
+        self.logger.info("Saving to NWB..")
+        for key, val in saved.items():
+            self._save_val(key, val, pynwb_obj)
+        self._save_val("saccades_fps", [self.fps], pynwb_obj)
+        self.logger.info("Done")
+
+    def _run_whole(self, pynwb_obj):
         # Extract eye position
         self.logger.info("Extracting eye position..")
-        x = self._get_req_val("x", pynwb_obj)
-        y = self._get_req_val("y", pynwb_obj)
-        likelihood = self._get_req_val("likelihood", pynwb_obj)
+        x = np.array(self._get_req_val("x", pynwb_obj)[:], dtype=np.float64)
+        y = np.array(self._get_req_val("y", pynwb_obj)[:], dtype=np.float64)
+        likelihood = np.asarray(self._get_req_val("likelihood", pynwb_obj)[:])
         x[likelihood < self.likelihood_threshold] = np.nan  # Set eye pos values to nan if they don't meet the threshold
         y[likelihood < self.likelihood_threshold] = np.nan
         # if >10%, then error, else interpolate
@@ -166,137 +257,412 @@ class PutativeSaccadesEnrichment(Enrichment):
         if len(np.where(np.isnan(x))[0]) > ten_percent or len(np.where(np.isnan(y))[0]) > ten_percent:
             raise ValueError("More than 10% of datapoints in CSV are NaN! Unable to continue!")
 
-        corrected = self._correct_eye_position(x, y, pynwb_obj)  # pose/corrected
-        corrected[:, 0] = self._interpolate_eyeposition(corrected[:, 0])
-        corrected[:, 1] = self._interpolate_eyeposition(corrected[:, 1])  # Remove NaNs
+        timestamps = np.asarray(self._get_req_val("timestamps", pynwb_obj))
+
+        # Each stage is cached on its inputs and parameters (if caching is enabled) so only changed stages are re-run
+        corrected = self._run_stage("correct", self._correct_and_fill_eye_position, [x, y, timestamps])  # pose/corrected
+        interpolated = self._run_stage("interpolate", self._interpolate_eye_position, [corrected])  # pose/interpolated
+        decomposed, missing_data_mask = self._run_stage("decompose", self._decompose_eye_position, [interpolated])  # pose/decomposed and pose/missing/<eye>
+        reoriented = self._run_stage("reorient", self._reorient_eye_position, [decomposed, corrected])  # pose/reoriented
+        filtered = self._run_stage("filter", self._filter_eye_position, [reoriented, missing_data_mask], {"fps": self.fps})  # pose/filtered
+        saccade_waveforms, saccade_indices = self._run_stage("detect", self._detect_putative_saccades, [filtered], {
+            "fps": self.fps,
+            "amplitude_threshold": self.amplitude_threshold,
+            "min_inter_peak_interval": self.min_inter_peak_interval,
+            "perisaccadic_window": PERISACCADIC_WINDOW_IN_SECONDS
+        })  # saccades/putative/{eye}/<indices and waveform>
 
-        interpolated = self._interpolate_eye_position(corrected)  # pose/interpolated
-        decomposed, missing_data_mask = self._decompose_eye_position(interpolated)  # pose/decomposed and pose/missing/<eye>
-        reoriented = self._reorient_eye_position(decomposed, corrected)  # pose/reoriented
-        filtered = self._filter_eye_position(reoriented, missing_data_mask)  # pose/filtered
-        saccade_waveforms, saccade_indices = self._detect_putative_saccades(filtered)  # saccades/putative/{eye}/<indices and waveform>
+        return {
+            "pose_corrected": corrected,
+            "pose_interpolated": interpolated,
+            "pose_decomposed": decomposed,
+            "pose_missing": missing_data_mask,
+            "pose_reoriented": reoriented,
+            "pose_filtered": filtered,
+            "saccades_putative_peak_indices": saccade_indices,
+            "saccades_putative_waveforms": saccade_waveforms
+        }
 
-        self.logger.info("Saving to NWB..")
-        self._save_val("pose_corrected", corrected, pynwb_obj)
-        self._save_val("pose_interpolated", interpolated, pynwb_obj)
-        self._save_val("pose_decomposed", decomposed, pynwb_obj)
-        self._save_val("pose_missing", missing_data_mask, pynwb_obj)
-        self._save_val("pose_reoriented", reoriented, pynwb_obj)
-        self._save_val("pose_filtered", filtered, pynwb_obj)
-        self._save_val("saccades_putative_peak_indices", saccade_indices, pynwb_obj)
-        self._save_val("saccades_putative_waveforms", saccade_waveforms, pynwb_obj)
-        self._save_val("saccades_fps", [self.fps], pynwb_obj)
-        self.logger.info("Done")
+    def _alloc(self, shape, dtype=np.float64):
+        # Disk backed array for the chunked mode, so only the chunk being worked on needs to be in memory
+        path = os.path.join(self._chunk_dir, f"putative-{uuid.uuid4()}.dat")
+        arr = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+        try:
+            os.remove(path)  # The mapping keeps the data around until it's garbage collected
+        except PermissionError:
+            pass  # Windows can't remove a mapped file, will be left in the chunk dir
+        return arr
+
+    def _windows(self, size, overlap=0):
+        # Yields (window_start, window_stop, core_start, core_stop) where the core is chunk_size frames and the window
+        # is the core plus the overlap on either side, so results in the core match running over the whole array
+        for core_start in range(0, size, self.chunk_size):
+            core_stop = min(core_start + self.chunk_size, size)
+            yield max(core_start - overlap, 0), min(core_stop + overlap, size), core_start, core_stop
+
+    def _next_finite(self, column, start):
+        # First finite (idx, val) in column at or after start, (size, None) if there isn't one
+        for search_start in range(start, column.shape[0], self.chunk_size):
+            search = np.asarray(column[search_start:search_start + self.chunk_size])
+            finite_idxs = np.where(np.isfinite(search))[0]
+            if finite_idxs.size:
+                return search_start + finite_idxs[0], search[finite_idxs[0]]
+        return column.shape[0], None
+
+    def _fill_nans_chunked(self, column, out):
+        # Same as np.interp over the finite values of the column, a chunk at a time. column and out can be the same
+        size = column.shape[0]
+        prev_point = None  # Last finite (idx, val) before the current chunk
+        next_point = None  # First finite (idx, val) after the current chunk
+        for _, _, start, stop in self._windows(size):
+            chunk = np.array(column[start:stop])
+            finite_idxs = np.where(np.isfinite(chunk))[0]
+            xp = [finite_idxs + start]
+            fp = [chunk[finite_idxs]]
+
+            if prev_point is not None:
+                xp.insert(0, [prev_point[0]])
+                fp.insert(0, [prev_point[1]])
+            if finite_idxs.size == 0 or finite_idxs[-1] != chunk.size - 1:  # NaNs at the end of the chunk
+                if next_point is None or next_point[0] < stop:
+                    next_point = self._next_finite(column, stop)
+                if next_point[1] is not None:
+                    xp.append([next_point[0]])
+                    fp.append([next_point[1]])
+
+            xp = np.concatenate(xp)
+            if xp.size == 0:
+                raise ValueError("Cannot interpolate, no finite values exist!")
+            out[start:stop] = np.interp(np.arange(start, stop), xp, np.concatenate(fp))
+
+            if finite_idxs.size:
+                prev_point = (start + finite_idxs[-1], chunk[finite_idxs[-1]])
+
+    def _run_chunked(self, pynwb_obj):
+        self.logger.info(f"Running in chunked mode, '{self.chunk_size}' frames at a time..")
+        x_data = self._get_req_val("x", pynwb_obj)
+        y_data = self._get_req_val("y", pynwb_obj)
+        likelihood_data = self._get_req_val("likelihood", pynwb_obj)
+        timestamps = np.asarray(self._get_req_val("timestamps", pynwb_obj))
+        num_positions = len(x_data)
+
+        # Correct eye position, scatter each chunk of positions into place using the dropped frame offsets
+        self.logger.info("Correcting eye position..")
+        frame_offsets = np.cumsum(np.round(timestamps / np.median(timestamps)).astype(int) - 1)
+        num_frames = min(timestamps.shape[0], num_positions)
+        total_frames = timestamps.shape[0] + (int(frame_offsets[-1]) if frame_offsets.size else 0)
+        corrected = self._alloc((total_frames, 2))
+        for _, _, start, stop in self._windows(total_frames):
+            corrected[start:stop] = np.nan
+
+        x_nan_count = 0
+        y_nan_count = 0
+        for _, _, start, stop in self._windows(num_positions):
+            x = np.array(x_data[start:stop], dtype=np.float64)
+            y = np.array(y_data[start:stop], dtype=np.float64)
+            likelihood = np.asarray(likelihood_data[start:stop])
+            x[likelihood < self.likelihood_threshold] = np.nan  # Set eye pos values to nan if they don't meet the threshold
+            y[likelihood < self.likelihood_threshold] = np.nan
+            x_nan_count = x_nan_count + np.count_nonzero(np.isnan(x))
+            y_nan_count = y_nan_count + np.count_nonzero(np.isnan(y))
+            if start < num_frames:
+                stop = min(stop, num_frames)
+                frame_idxs = np.arange(start, stop) + frame_offsets[start:stop]
+                corrected[frame_idxs, 0] = x[:stop - start]
+                corrected[frame_idxs, 1] = y[:stop - start]
+
+        ten_percent = int(num_positions * .1)
+        if x_nan_count > ten_percent or y_nan_count > ten_percent:
+            raise ValueError("More than 10% of datapoints in CSV are NaN! Unable to continue!")
+        for col_idx in range(2):
+            self._fill_nans_chunked(corrected[:, col_idx], corrected[:, col_idx])  # Remove NaNs
+
+        # Interpolate windows of dropped frames, overlap so every window has a valid frame on either side
+        self.logger.info("Interpolating eye position..")
+        interpolated = self._alloc((total_frames, 2))
+        overlap = self.MAX_DROPPED_FRAMES + 2
+        for win_start, win_stop, start, stop in self._windows(total_frames, overlap):
+            window = self._interpolate_dropped_frames(np.array(corrected[win_start:win_stop]))
+            interpolated[start:stop] = window[start - win_start:stop - win_start]
 
-    def _correct_eye_position(self, x, y, pynwb_obj):
+        # Decompose eye position, one pass for the means and covariance, one to project
+        self.logger.info("Decomposing eye position..")
+        shift = self._decomposition_shift(np.asarray(interpolated[:self.chunk_size]))
+        sums = np.zeros(10)
+        for _, _, start, stop in self._windows(total_frames):
+            sums = sums + self._decomposition_sums(np.asarray(interpolated[start:stop]), shift)
+        mean, components = self._decomposition_from_sums(sums, shift)
+
+        decomposed = self._alloc((total_frames, 2))
+        missing_data_mask = self._alloc((total_frames,), dtype=bool)
+        for _, _, start, stop in self._windows(total_frames):
+            decomposed[start:stop], missing_data_mask[start:stop] = self._project_eye_position(np.asarray(interpolated[start:stop]), mean, components)
+
+        # Reorient, one pass for the correlation with the corrected position then flip the sign of each column
+        self.logger.info("Reorienting eye position..")
+        sums = np.zeros((6, 2))
+        for _, _, start, stop in self._windows(total_frames):
+            sums = sums + self._correlation_sums(np.asarray(corrected[start:stop]), np.asarray(decomposed[start:stop]))
+        corr_coeffs, p_vals = self._correlation_from_sums(sums)
+        signs = np.array([self._orientation_sign(col_idx, corr_coeffs[col_idx], p_vals[col_idx]) for col_idx in range(2)])
+
+        reoriented = self._alloc((total_frames, 2))
+        for _, _, start, stop in self._windows(total_frames):
+            reoriented[start:stop] = decomposed[start:stop] * signs
+
+        # Filter, fill NaNs over the whole column first so NaN runs crossing a chunk edge are filled the same way
+        self.logger.info("Filtering eye position..")
+        smoothing_window_size = self._filter_window_size()
+        filled = self._alloc((total_frames, 2))
+        for col_idx in range(2):
+            self._fill_nans_chunked(reoriented[:, col_idx], filled[:, col_idx])
+
+        filtered = self._alloc((total_frames, 2))
+        for win_start, win_stop, start, stop in self._windows(total_frames, smoothing_window_size):
+            smoothed = self._smooth_columns(np.asarray(filled[win_start:win_stop]), smoothing_window_size)
+            filtered[start:stop] = smoothed[start - win_start:stop - win_start]
+            filtered[start:stop][np.asarray(missing_data_mask[start:stop])] = np.nan  # re-set nan vals
+        del filled
+
+        # Detect putative saccades, the velocity is kept whole since the threshold is a percentile of all of it
+        self.logger.info("Extracting putative saccades..")
+        saccade_dist_threshold, peak_offsets, window_len = self._detection_params()
+        imputed_x = self._alloc((total_frames,))
+        self._fill_nans_chunked(filtered[:, 0], imputed_x)
+
+        velocity = np.empty(max(total_frames - 1, 0))
+        for win_start, win_stop, start, stop in self._windows(total_frames - 1, window_len):
+            # forward difference of the x vals, needs the frame after the window too
+            smoothed = self._smooth_columns(np.diff(np.asarray(imputed_x[win_start:win_stop + 1])), window_len)
+            velocity[start:stop] = np.abs(smoothed[start - win_start:stop - win_start])
+        del imputed_x
+
+        height_threshold = np.percentile(velocity, self.amplitude_threshold * 100)  # Percentile of the velocity at the thres
+        peak_idxs, peak_props = scipy.signal.find_peaks(velocity, height=height_threshold, distance=saccade_dist_threshold)
+        saccade_waveforms, saccade_indices = self._extract_waveforms(filtered, peak_idxs, peak_offsets)
+        self.logger.info(f"Detected '{saccade_waveforms.shape[0]}' putative saccade waveforms under '{self._stim_name}'")
+
+        return {
+            "pose_corrected": corrected,
+            "pose_interpolated": interpolated,
+            "pose_decomposed": decomposed,
+            "pose_missing": missing_data_mask,
+            "pose_reoriented": reoriented,
+            "pose_filtered": filtered,
+            "saccades_putative_peak_indices": saccade_indices,
+            "saccades_putative_waveforms": saccade_waveforms
+        }
+
+    def _run_stage(self, stage_name, stage_func, inputs, params=None):
+        # Run a stage of the pipeline, pulling the output from the cache if the inputs and params have been seen before
+        if self._cache is None:
+            return stage_func(*inputs)
+
+        key = self._cache.key(stage_name, inputs, params or {})
+        outputs = self._cache.get(key)
+        if outputs is not None:
+            self.logger.info(f"Using cached output for stage '{stage_name}'..")
+            return outputs
+
+        outputs = stage_func(*inputs)
+        self._cache.put(key, outputs)
+        return outputs
+
+    def _correct_and_fill_eye_position(self, x, y, timestamps):
+        corrected = self._correct_eye_position(x, y, timestamps)
+        corrected[:, 0] = self._interpolate_eyeposition(corrected[:, 0])
+        corrected[:, 1] = self._interpolate_eyeposition(corrected[:, 1])  # Remove NaNs
+        return corrected
+
+    def _correct_eye_position(self, x, y, timestamps):
         self.logger.info("Correcting eye position..")
-        corrected = np.full([x.shape[0] + int(1e6), 2], np.nan)
-        timestamps = self._get_req_val("timestamps", pynwb_obj)
+        timestamps = np.asarray(timestamps)
         factor = np.median(timestamps)
 
-        frame_offset = 0
-        frame_idx = 0
-        missing_frames = 0
+        # Each timestamp is the interval since the last frame, any interval that is a multiple of the median means
+        # frames were dropped, so every frame after it is shifted over by the running total of dropped frames
+        frame_offsets = np.cumsum(np.round(timestamps / factor).astype(int) - 1)
+        num_frames = min(timestamps.shape[0], x.shape[0])
+        missing_frames = timestamps.shape[0] - num_frames  # Timestamps without a matching eye position
+        if missing_frames > 0:
+            self.logger.info(f"Found '{missing_frames}' timestamps without a matching eye position, leaving as NaN")
 
-        for frame in timestamps:
-            frame_offset = frame_offset + (round(frame / factor) - 1)  # Increment frame
-            if frame_idx >= x.shape[0]:
-                missing_frames = missing_frames + 1
-            else:
-                corrected[frame_idx + frame_offset] = np.array([x[frame_idx], y[frame_idx]])
-            frame_idx = frame_idx + 1
+        total_frames = timestamps.shape[0] + (int(frame_offsets[-1]) if frame_offsets.size else 0)
+        corrected = np.full([total_frames, 2], np.nan)
+        frame_idxs = np.arange(num_frames) + frame_offsets[:num_frames]
+        corrected[frame_idxs, 0] = x[:num_frames]
+        corrected[frame_idxs, 1] = y[:num_frames]
 
-        corrected = corrected[:frame_idx + frame_offset, :]
         return corrected
 
-    def _interpolate_eye_position(self, corrected):
+    @staticmethod
+    def _dropped_frame_runs(dropped):
+        # Run-length encode a boolean mask, returns the start (inclusive) and stop (exclusive) indexes of each run
+        edges = np.diff(np.concatenate(([0], dropped.astype(np.int8), [0])))
+        starts = np.where(edges == 1)[0]
+        stops = np.where(edges == -1)[0]
+        return starts, stops
+
+    def _interpolate_eye_position(self, corrected, max_dropped_frames=MAX_DROPPED_FRAMES):
         self.logger.info("Interpolating eye position..")
+        return self._interpolate_dropped_frames(corrected, max_dropped_frames)
+
+    @classmethod
+    def _interpolate_dropped_frames(cls, corrected, max_dropped_frames=MAX_DROPPED_FRAMES):
         interpolated = np.copy(corrected)
-        for col_idx in [0, 1]:  # Loop over the two columns (x,y) and interpolate both, one at at time
+        for col_idx in [0, 1]:  # Loop over the two columns (x,y) and interpolate both, each with their own windows
             to_interpl = interpolated[:, col_idx]
             dropped = np.isnan(to_interpl)
-            windows = []
-
-            row_idx = 0
-            while True:  # Find windows of dropped frames, append to list of idxs
-                if row_idx >= dropped.size:
-                    break
-                row_dropped = dropped[row_idx]
-
-                if row_dropped:
-                    num_dropped = 0
-                    for rdropped in dropped[row_idx:]:  # Go over until we find a frame that wasn't dropped
-                        if not rdropped:
-                            break
-                        num_dropped = num_dropped + 1
-
-                    if num_dropped <= 4:  # If we drop more than 4 frames in a row
-                        if row_idx + num_dropped + 1 >= to_interpl.size:
-                            row_idx = row_idx + num_dropped
-                            continue  # Skip over these dropped rows and don't interpolate them
-                        else:
-                            windows.append([row_idx - 1, row_idx + num_dropped + 1])
-                    row_idx = row_idx + num_dropped
-                else:  # Our row was not dropped
-                    row_idx = row_idx + 1
-
-        for start, stop in windows:
-            xframes = np.arange(start + 1, stop - 1, 1)
-            xvals = np.array([start, stop - 1])
-            yvals = np.array([to_interpl[start], to_interpl[stop - 1]])
-            interp_y = np.interp(xframes, xvals, yvals)
-            interpolated[start + 1: stop - 1, col_idx] = interp_y
+            starts, stops = cls._dropped_frame_runs(dropped)
+
+            # Only fill windows of 4 or fewer dropped frames that have a valid frame on either side of them
+            fillable = (stops - starts <= max_dropped_frames) & (starts > 0) & (stops + 1 < to_interpl.size)
+            if not np.any(fillable):
+                continue
+
+            # Mark every frame inside a fillable window, then linearly interpolate them all in one go
+            window_edges = np.zeros(to_interpl.size + 1, dtype=int)
+            window_edges[starts[fillable]] += 1
+            window_edges[stops[fillable]] -= 1
+            to_fill = np.cumsum(window_edges[:-1]).astype(bool)
+
+            valid_idxs = np.where(np.invert(dropped))[0]
+            to_interpl[to_fill] = np.interp(np.where(to_fill)[0], valid_idxs, to_interpl[valid_idxs])
 
         return interpolated
 
     def _decompose_eye_position(self, interpolated):
         self.logger.info("Decomposing eye position..")
-        # Fill in nan values with an imputer
-        imputer = SimpleImputer(missing_values=np.nan).fit_transform(interpolated)
-        missing_data_mask = np.isnan(interpolated).any(1)  # Remember which values were imputed
-
-        decomposed = PCA(n_components=2).fit_transform(imputer)  # PCA the eye positions from imputed data
-        decomposed[missing_data_mask] = np.nan  # Re-mark missing values with nan
+        # Mean impute nan values then PCA the eye positions, same result as sklearn's SimpleImputer and PCA
+        shift = self._decomposition_shift(interpolated)
+        mean, components = self._decomposition_from_sums(self._decomposition_sums(interpolated, shift), shift)
+        return self._project_eye_position(interpolated, mean, components)
 
-        return decomposed, missing_data_mask
+    @staticmethod
+    def _decomposition_sums(positions, shift):
+        # Running sums over (n, 2) positions for the mean imputation and the covariance of the imputed positions.
+        # Sums from consecutive chunks add up to the sums of the whole array. Positions are taken relative to shift
+        # (any typical position) so the sums of squares don't lose precision
+        missing = np.isnan(positions)
+        deviations = positions - shift
+        np.copyto(deviations, 0, where=missing)  # Missing values don't add to any of the sums
+        both = np.invert(missing[:, 0] | missing[:, 1])
+
+        # Sums of squares on the diagonal, sum of cross products off it. A missing value zeroes out its cross product,
+        # so only rows where both x and y are valid add to it
+        products = deviations.T @ deviations
+        return np.array([
+            positions.shape[0] - np.count_nonzero(missing[:, 0]),  # count
+            positions.shape[0] - np.count_nonzero(missing[:, 1]),
+            deviations[:, 0].sum(),  # sum
+            deviations[:, 1].sum(),
+            products[0, 0],  # sum of squares
+            products[1, 1],
+            np.count_nonzero(both),  # count where both x and y are valid
+            *(deviations.T @ both.astype(np.float64)),  # sum where both are valid
+            products[0, 1]  # sum of cross products
+        ])
 
-    def _reorient_eye_position(self, decomposed, corrected):
-        self.logger.info("Reorienting eye position..")
+    @classmethod
+    def _decomposition_shift(cls, positions):
+        # Mean of the first rows, close enough to the overall mean to use as the shift for _decomposition_sums
+        sums = cls._decomposition_sums(positions[:1000], 0)
+        return sums[2:4] / np.maximum(sums[0:2], 1)
 
-        reoriented = np.full_like(corrected, np.nan)
+    @staticmethod
+    def _decomposition_from_sums(sums, shift):
+        # Returns the imputation means and the (2, 2) PCA components (rows, largest variance first) from _decomposition_sums
+        counts, totals, squares = sums[0:2], sums[2:4], sums[4:6]
+        both_count, both_totals, cross = sums[6], sums[7:9], sums[9]
+        means = totals / counts
+
+        # Imputed values are the mean so they don't add to the variance or covariance
+        var = squares - counts * means * means
+        cov = cross - means[1] * both_totals[0] - means[0] * both_totals[1] + both_count * means[0] * means[1]
+
+        # Eigenvectors of the symmetric 2x2 covariance, the largest variance axis is at this angle and the other is
+        # perpendicular to it
+        angle = 0.5 * np.arctan2(2 * cov, var[0] - var[1])
+        components = np.array([
+            [np.cos(angle), np.sin(angle)],
+            [-np.sin(angle), np.cos(angle)]
+        ])
+        # Signs follow sklearn, the largest magnitude value of each component is positive
+        signs = np.sign(components[np.arange(2), np.argmax(np.abs(components), axis=1)])
+        return means + shift, components * signs[:, None]
 
-        for col_idx in range(2):  # loop over x, y cols
-            decomposed_column_copy = np.copy(decomposed[:, col_idx])
-            decomposed_column = decomposed[:, col_idx]
+    @staticmethod
+    def _project_eye_position(positions, mean, components):
+        # Returns the decomposed positions and the mask of rows that had a nan (and were imputed)
+        centered = positions - mean
+        missing = np.isnan(centered)
+        missing_data_mask = missing[:, 0] | missing[:, 1]  # Remember which values were imputed
+        np.copyto(centered, 0, where=missing)  # Imputed with the mean, so centered they are 0
+
+        decomposed = centered @ components.T
+        decomposed[missing_data_mask] = np.nan  # Re-mark missing values with nan
 
-            corrected_column = corrected[:, col_idx]
-            corrected_nan_idxs = np.where(np.isnan(corrected_column))[0]  # idxs where vals are nan
+        return decomposed, missing_data_mask
 
-            # delete nan values from column
-            corrected_column = np.delete(corrected_column, corrected_nan_idxs)
-            decomposed_column = np.delete(decomposed_column, corrected_nan_idxs)
+    @staticmethod
+    def _correlation_sums(corrected, decomposed):
+        # Per column count, sums, sums of squares and cross products, over the rows where corrected isn't nan.
+        # Sums from consecutive chunks add up to the sums of the whole array
+        missing = np.isnan(corrected)
+        both = np.empty((corrected.shape[0], 4), order="F")  # corrected and decomposed side by side, as [a_x, a_y, b_x, b_y]
+        both[:, :2] = corrected
+        both[:, 2:] = decomposed
+        np.copyto(both, 0, where=np.tile(missing, 2))  # Rows where corrected is nan don't add to any of the sums
+
+        sums = np.ones(both.shape[0]) @ both
+        products = both.T @ both  # Sums of squares and cross products of every pair of columns in one go
+        return np.array([
+            corrected.shape[0] - np.array([np.count_nonzero(missing[:, 0]), np.count_nonzero(missing[:, 1])]),
+            sums[:2],
+            sums[2:],
+            np.diag(products)[:2],
+            np.diag(products)[2:],
+            np.diag(products[:2, 2:])
+        ])
 
-            # Break down into pearson correlation coefficients and a (two tailed) p value
-            corr_coeff, p_val = scipy.stats.pearsonr(corrected_column, decomposed_column)
+    @staticmethod
+    def _correlation_from_sums(sums):
+        # Pearson correlation coefficient and two tailed p value (same as scipy.stats.pearsonr) from _correlation_sums
+        n, sum_a, sum_b, sum_aa, sum_bb, sum_ab = sums
+        cov = sum_ab - sum_a * sum_b / n
+        var_a = sum_aa - sum_a * sum_a / n
+        var_b = sum_bb - sum_b * sum_b / n
+        corr_coeff = np.clip(cov / np.sqrt(var_a * var_b), -1, 1)
+        with np.errstate(divide="ignore"):
+            t_stat = corr_coeff * np.sqrt((n - 2) / (1 - corr_coeff * corr_coeff))
+        p_val = 2 * scipy.special.stdtr(n - 2, -np.abs(t_stat))
+        return corr_coeff, p_val
 
-            if corr_coeff > 0.05 and p_val < 0.05:  # Signal is already oriented the correct direction
-                pass
-            elif corr_coeff < -0.05 and p_val < 0.05:
-                decomposed_column_copy = decomposed_column_copy * -1  # Flip signal sign
-            else:
-                raise ValueError(f"Could not determine correlation between raw and decomposed eye position. Column '{col_idx}' corr_coeff '{corr_coeff}' p_val '{p_val}'")
+    @staticmethod
+    def _orientation_sign(col_idx, corr_coeff, p_val):
+        if corr_coeff > 0.05 and p_val < 0.05:  # Signal is already oriented the correct direction
+            return 1
+        elif corr_coeff < -0.05 and p_val < 0.05:
+            return -1  # Flip signal sign
+        else:
+            raise ValueError(f"Could not determine correlation between raw and decomposed eye position. Column '{col_idx}' corr_coeff '{corr_coeff}' p_val '{p_val}'")
 
-            reoriented[:, col_idx] = decomposed_column_copy  # set reoriented to (possibly) flipped signal
+    def _reorient_eye_position(self, decomposed, corrected):
+        self.logger.info("Reorienting eye position..")
 
-            # TODO: Check that left and right eye position is anti-correlated
+        # Pearson correlation coefficients and (two tailed) p values of both x, y cols at once, ignoring rows where
+        # the corrected position is nan
+        corr_coeffs, p_vals = self._correlation_from_sums(self._correlation_sums(corrected, decomposed))
+        signs = np.array([self._orientation_sign(col_idx, corr_coeffs[col_idx], p_vals[col_idx]) for col_idx in range(2)])
 
-        return reoriented
+        # decomposed is saved on its own, so flip the signal signs into a single new array
+        reoriented = np.multiply(decomposed, signs)
 
-    def _filter_eye_position(self, reoriented, missing_data_mask):
-        self.logger.info("Filtering eye position..")
+        # TODO: Check that left and right eye position is anti-correlated
 
-        filtered = np.full_like(reoriented, np.nan)
+        return reoriented
 
+    def _filter_window_size(self):
         smoothing_time_window_size = 25
 
         smoothing_window_size = 1 / self.fps * 1000
@@ -304,79 +670,95 @@ class PutativeSaccadesEnrichment(Enrichment):
         smoothing_window_size = round(smoothing_window_size)
         if smoothing_window_size % 2 == 0:
             smoothing_window_size = smoothing_window_size + 1  # Make sure that the window size is odd
+        return smoothing_window_size
+
+    @staticmethod
+    def _fill_nan_columns(arr):
+        # Copy of arr with the nan values of each column linearly interpolated over, like interpolate_flat_arr
+        filled = np.array(arr, dtype=np.float64)
+        columns = filled.reshape(filled.shape[0], -1)
+        for col_idx in range(columns.shape[1]):
+            missing = np.isnan(columns[:, col_idx])
+            if np.any(missing):
+                valid_idxs = np.where(np.invert(missing))[0]
+                columns[missing, col_idx] = np.interp(np.where(missing)[0], valid_idxs, columns[valid_idxs, col_idx])
+        return filled
+
+    @staticmethod
+    def _smooth_columns(arr, window_size):
+        # Same as smooth_flat_arr (hanning window with mirrored edges) on every column of arr along axis 0, in one call
+        if window_size < 3:
+            raise ValueError("Window size must be odd and greater than or equal to 3")
+        if arr.shape[0] < window_size:
+            raise ValueError("Input array is smaller than the smoothing window")
+        weights = np.hanning(window_size)
+        return scipy.ndimage.correlate1d(arr, weights / weights.sum(), axis=0, mode="mirror")
+
+    def _filter_eye_position(self, reoriented, missing_data_mask):
+        self.logger.info("Filtering eye position..")
+        smoothing_window_size = self._filter_window_size()
 
-        for col_idx in range(2):  # Iterate over the x,y cols of the (n, 2) arr
-            interp_reori = interpolate_flat_arr(reoriented[:, col_idx])  # Fill out nan values
-            smoothed_reori = smooth_flat_arr(interp_reori, window_size=smoothing_window_size)  # convolve array
-            smoothed_reori[missing_data_mask] = np.nan  # re-set nan vals
-            filtered[:, col_idx] = smoothed_reori
+        # Fill out nan values, then smooth both x,y cols of the (n, 2) arr at once
+        filtered = self._smooth_columns(self._fill_nan_columns(reoriented), smoothing_window_size)
+        filtered[missing_data_mask] = np.nan  # re-set nan vals
 
         return filtered
 
-    def _detect_putative_saccades(self, filtered):
-        amplitude_threshold = 0.99
-        min_inter_peak_interval = 0.075
+    def _detection_params(self):
+        # Returns the min distance between peaks, the waveform offsets around each peak and the velocity smoothing window
         perisacc_window = PERISACCADIC_WINDOW_IN_SECONDS
         center_sacc_waveforms = False
         smoothing_window_size = 0.025
 
-        self.logger.info("Extracting putative saccades..")
-        saccade_dist_threshold = self.fps * min_inter_peak_interval  # Minimum inter-saccade interval (in seconds)
+        saccade_dist_threshold = self.fps * self.min_inter_peak_interval  # Minimum inter-saccade interval (in seconds)
         peak_offsets = np.array([  # Sample offset added to each peak sample index
             round(perisacc_window[0] * self.fps),
             round(perisacc_window[1] * self.fps)
         ])
-
-        num_features = peak_offsets[1] - peak_offsets[0]  # N samples across saccades waveforms
+        if center_sacc_waveforms:
+            peak_offsets[1] = peak_offsets[1] + 1  # If aligning center, offset by 1
 
         window_len = round(smoothing_window_size * self.fps)
         if window_len % 2 == 0:
             window_len += 1  # ensure window length is odd
 
-        # Impute over filtered data
-        imputed = np.full_like(filtered, np.nan)
-        for col_idx in range(2):  # Iterate over cols, (x, y)
-            col = filtered[:, col_idx]
+        return saccade_dist_threshold, peak_offsets, window_len
 
-            imputed[:, col_idx] = np.interp(
-                np.arange(col.size),
-                np.arange(col.size)[np.isfinite(col)],  # Only where values are non-nan and non-inf
-                col[np.isfinite(col)]
-            )
+    @staticmethod
+    def _extract_waveforms(filtered, peak_idxs, peak_offsets):
+        # Exclude incomplete waveforms that would run off either end of the data
+        in_bounds = (peak_idxs + peak_offsets[0] >= 0) & (peak_idxs + peak_offsets[1] <= filtered.shape[0])
+        saccade_indicies = peak_idxs[in_bounds]
+
+        # Extract all saccade waveforms at once as (saccadenum, time, x/y)
+        saccade_waveforms = np.asarray(filtered[saccade_indicies[:, None] + np.arange(peak_offsets[0], peak_offsets[1])])
 
-        saccade_indicies = []
-        saccade_waveforms = []
+        return saccade_waveforms, saccade_indicies
+
+    def _detect_putative_saccades(self, filtered):
+        self.logger.info("Extracting putative saccades..")
+        saccade_dist_threshold, peak_offsets, window_len = self._detection_params()
+
+        # Impute over filtered data, only the x vals are used for the velocity
+        x_col = filtered[:, 0]
+        imputed_x = np.interp(
+            np.arange(x_col.size),
+            np.arange(x_col.size)[np.isfinite(x_col)],  # Only where values are non-nan and non-inf
+            x_col[np.isfinite(x_col)]
+        )
 
         velocity = np.abs(
-            smooth_flat_arr(
-                np.diff(imputed[:, 0]),  # forward difference of the x vals
+            self._smooth_columns(
+                np.diff(imputed_x),  # forward difference of the x vals
                 window_len
             )
         )
-        height_threshold = np.percentile(velocity, amplitude_threshold * 100)  # Percentile of the velocity at the thres
+        height_threshold = np.percentile(velocity, self.amplitude_threshold * 100)  # Percentile of the velocity at the thres
 
-        # Get saccade waveforms, filtering out waveforms with an invalid length
+        # Get saccade waveforms, peaks are already in chronological order
         peak_idxs, peak_props = scipy.signal.find_peaks(velocity, height=height_threshold, distance=saccade_dist_threshold)
-        for peak_idx in peak_idxs:
-            # If aligning center, offset by 1
-            if center_sacc_waveforms:
-                peak_offsets[1] = peak_offsets[1] + 1
-
-            # Extract saccade waveform
-            start_idx = peak_idx + peak_offsets[0]
-            stop_idx = peak_idx + peak_offsets[1]
-
-            saccade_waveform = filtered[start_idx:stop_idx, :]
-            if saccade_waveform.shape[0] != num_features:  # Exclude incomplete waveforms
-                continue
-
-            saccade_waveforms.append(saccade_waveform)
-            saccade_indicies.append(peak_idx)
+        saccade_waveforms, saccade_indicies = self._extract_waveforms(filtered, peak_idxs, peak_offsets)
 
-        # Sort the putative saccades by chronological order
-        sorted_idxs = np.argsort(saccade_indicies)
-        saccade_waveforms = np.array(saccade_waveforms)[sorted_idxs]
-        saccade_indicies = np.array(saccade_indicies)[sorted_idxs]
         self.logger.info(f"Detected '{saccade_waveforms.shape[0]}' putative saccade waveforms under '{self._stim_name}'")
 
         return saccade_waveforms, saccade_indicies
@@ -2,14 +2,19 @@ import pendulum
 from pynwb import NWBHDF5IO
 from pynwb.file import Subject
 from simply_nwb import SimpleNWB
-from simply_nwb.pipeline import NWBSession
 from simply_nwb.pipeline.enrichments.saccades import PutativeSaccadesEnrichment
 from simply_nwb.pipeline.enrichments.saccades.predict_gui import PredictedSaccadeGUIEnrichment
 import random
 import os
+import sys
+
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.batch_enrich import enrich_and_save, fit_enrichment, run_batch_enrichment
 
 NUM_TRAINING_FILES = 5
 RECORDING_FPS = 150
+NUM_WORKERS = 4  # Number of sessions to enrich in parallel, 1 runs everything in this process
 
 
 def find_training_putatives(foldername):
@@ -26,26 +31,36 @@ def find_training_putatives(foldername):
     return trainings
 
 
-def process_sess(foldername, filename):
-    sess = NWBSession(os.path.join(foldername, filename))
-    # Take our putative saccades and do the actual prediction for the start, end time, and time location
-    print("Adding predictive data..")
-    enrich = PredictedSaccadeGUIEnrichment(RECORDING_FPS, find_training_putatives(foldername), 40, {
-        "x_center": "center_x", "y_center": "center_y", "likelihood": "center_likelihood"})
+def create_enrichment(foldername):
+    # Picks the training files and trains or loads the models, only needs to happen once for a folder of sessions
+    return fit_enrichment(PredictedSaccadeGUIEnrichment(RECORDING_FPS, find_training_putatives(foldername), 40, {
+        "x_center": "center_x", "y_center": "center_y", "likelihood": "center_likelihood"}))
 
-    sess.enrich(enrich)
-    print("Saving to NWB")
+
+def predicted_filename(filename):
     new_filename = filename[len("putative-"):]  # Remove the 'putative-' prefix from the filename to generate a new one
     new_filename = "predicted-" + new_filename
-    sess.save(new_filename)  # Save as our finalized session, ready for analysis
+    return new_filename
+
+
+def process_sess(foldername, filename, enrich=None):
+    # Take our putative saccades and do the actual prediction for the start, end time, and time location
+    print("Adding predictive data..")
+    if enrich is None:
+        enrich = create_enrichment(foldername)
+
+    enrich_and_save(enrich, os.path.join(foldername, filename), predicted_filename(filename))  # Save as our finalized session, ready for analysis
     tw = 2
 
 
 def main():
+    enrich = create_enrichment("putative")
+    jobs = []
     for filename in os.listdir("putative"):
         if filename.endswith(".nwb"):
-            process_sess("putative", filename)
+            jobs.append((os.path.join("putative", filename), predicted_filename(filename)))
 
+    run_batch_enrichment(enrich, jobs, workers=NUM_WORKERS)
 
 
 if __name__ == "__main__":
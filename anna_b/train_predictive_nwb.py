@@ -6,15 +6,23 @@
 import glob
 import os
 import random
+import sys
 
 import pendulum
 from pynwb import NWBHDF5IO
 from pynwb.file import Subject
 from simply_nwb import SimpleNWB
-from simply_nwb.pipeline import NWBSession
 from simply_nwb.pipeline.enrichments.saccades import PutativeSaccadesEnrichment
 from simply_nwb.pipeline.enrichments.saccades.predict_gui import PredictedSaccadeGUIEnrichment
 
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.batch_enrich import SACCADE_MODEL_FILENAMES, fit_enrichment, run_outdated_enrichment
+from conversion_utils.manifest import BuildManifest
+
+NUM_WORKERS = 4  # Number of files to enrich in parallel, 1 runs everything in this process
+MANIFEST_FILENAME = "manifest.json"  # Kept in the output folder, records which putative NWB and models each predicted NWB was made from
+
 def select_putative_training_nwbs(list_of_nwbs, doskip):
     if doskip:
         return [list_of_nwbs[0]]
@@ -22,30 +30,37 @@ def select_putative_training_nwbs(list_of_nwbs, doskip):
     random.shuffle(list_of_nwbs)
     return list_of_nwbs[:5]
 
-# Get the filenames for the timestamps.txt and dlc CSV
-input_folder = "putative/"
-output_folder = "predicted/"
-num_saccades = 100
-skip_load_trainingdata = False
-
-files = glob.glob(os.path.join(input_folder, "**.nwb"))
-print("Creating enrichment..")
-enrich = PredictedSaccadeGUIEnrichment(200, select_putative_training_nwbs(files, skip_load_trainingdata), num_saccades, 
-{"x_center": "center_x", 
- "y_center": "center_y", 
- "likelihood": "center_likelihood"
-})
-
-for file in files:
-    savefn = os.path.join(output_folder, f"predictive-{os.path.basename(file)[:-len('.nwb')]}.nwb")
-    if os.path.exists(savefn):
-        print(f"File exists, skipping '{savefn}'..")
-    print(f"Loading '{file}'..")
-    sess = NWBSession(file)
+def main():
+    # Get the filenames for the timestamps.txt and dlc CSV
+    input_folder = "putative/"
+    output_folder = "predicted/"
+    num_saccades = 100
+    skip_load_trainingdata = False
+
+    files = glob.glob(os.path.join(input_folder, "**.nwb"))
+    print("Creating enrichment..")
+    # Models are loaded (or labeled and trained) once here, the fitted models are then shared with every worker
+    enrich = fit_enrichment(PredictedSaccadeGUIEnrichment(200, select_putative_training_nwbs(files, skip_load_trainingdata), num_saccades, 
+    {"x_center": "center_x", 
+     "y_center": "center_y", 
+     "likelihood": "center_likelihood"
+    }))
+
+    # Bump the version to regenerate everything
+    params = {"enrichment": "PredictedSaccadeGUIEnrichment", "num_saccades": num_saccades, "version": 1}
+
+    jobs = []
+    for file in files:
+        savefn = os.path.join(output_folder, f"predictive-{os.path.basename(file)[:-len('.nwb')]}.nwb")
+        jobs.append((file, savefn))
+
     # Take our putative saccades and do the actual prediction for the start, end time, and time location
-    print("Enriching..")
-    sess.enrich(enrich)
-    print("Saving to NWB")
-    print(f"Saving to file {savefn}..")
-    sess.save(savefn)  # Save as our finalized session, ready for analysis
+    # Existing files are skipped unless their putative NWB or the models in predict_gui_*.pickle changed
+    with BuildManifest(os.path.join(output_folder, MANIFEST_FILENAME)) as manifest:
+        run_outdated_enrichment(enrich, jobs, manifest, params, SACCADE_MODEL_FILENAMES, workers=NUM_WORKERS)
     tw = 2
+
+
+# Worker processes re-import this file on Windows, so only run from here
+if __name__ == "__main__":
+    main()
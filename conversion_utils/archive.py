@@ -0,0 +1,145 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+COPY_BUFFER_BYTES = 16 * 2 ** 20
+SAMPLE_COUNT = 8  # Number of blocks spread across a file that are compressed to estimate how compressible it is
+SAMPLE_BLOCK_BYTES = 2 ** 20
+MIN_SAVINGS = 0.05  # Members the samples don't shrink by at least this fraction are stored uncompressed
+
+
+def sample_compressibility(filename, level=6, sample_count=SAMPLE_COUNT, block_bytes=SAMPLE_BLOCK_BYTES):
+    # Estimated compressed size / original size of a file, from deflating a few blocks spread evenly across it.
+    # NWBs with compressed HDF5 datasets come out close to 1
+    size = os.path.getsize(filename)
+    if size == 0:
+        return 1.0
+
+    last_offset = max(size - block_bytes, 0)
+    offsets = sorted(set(idx * last_offset // max(sample_count - 1, 1) for idx in range(sample_count)))
+    raw_bytes = 0
+    compressed_bytes = 0
+    with open(filename, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            block = f.read(block_bytes)
+            raw_bytes += len(block)
+            compressed_bytes += len(zlib.compress(block, level))
+    return compressed_bytes / raw_bytes
+
+
+def _deflate_to_file(filename, out_filename, level):
+    # Runs in a worker process. Raw deflate stream (what a zip member holds) of filename written to out_filename
+    # Returns the crc32 of the original data, the compressed size and how long it took
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    with open(filename, "rb") as fin, open(out_filename, "wb") as fout:
+        for block in iter(lambda: fin.read(COPY_BUFFER_BYTES), b""):
+            crc = zlib.crc32(block, crc)
+            fout.write(compressor.compress(block))
+        fout.write(compressor.flush())
+    return crc, os.path.getsize(out_filename), time.perf_counter() - start
+
+
+def _zip_write_precompressed(zipf, zinfo, data_filename):
+    # zipfile has no public way to add an already compressed member, so this does what ZipFile.open(zinfo, "w") and
+    # closing it do, with the data copied straight from data_filename. zinfo needs its CRC and sizes set
+    with zipf._lock:
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        with open(data_filename, "rb") as f:
+            shutil.copyfileobj(f, zipf.fp, COPY_BUFFER_BYTES)
+
+        zipf.start_dir = zipf.fp.tell()
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _print_throughput(arcname, method, size, seconds):
+    megabytes = size / 2 ** 20
+    print(f"{arcname} {method} {megabytes:.1f}MB in {seconds:.1f}s ({megabytes / max(seconds, 1e-6):.1f} MB/s)")
+
+
+def build_zip(output_filename, filenames, workers=4, level=6, min_savings=MIN_SAVINGS, tmp_dir=None):
+    """
+    Write files to a zip archive (named by their basename), only compressing the ones that are worth it. Each file's
+    compressibility is sampled first, files that won't shrink by min_savings are stored as is, the rest are deflated
+    in parallel worker processes into temp files and then copied into the archive in order
+
+    :param output_filename: zip file to write
+    :param filenames: files to put in the archive
+    :param workers: Number of files to compress in parallel
+    :param level: zlib compression level
+    :param min_savings: fraction a file has to shrink by to be compressed
+    :param tmp_dir: folder for the compressed temp files (needs room for them), defaults to the system temp dir
+    """
+    to_compress = []
+    for filename in filenames:
+        ratio = sample_compressibility(filename, level)
+        compress = ratio <= 1 - min_savings
+        print(f"Sampled {filename} compresses to ~{ratio * 100:.0f}%, {'deflating' if compress else 'storing'}")
+        if compress:
+            to_compress.append(filename)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_folder, \
+            ProcessPoolExecutor(max_workers=workers) as executor, \
+            zipfile.ZipFile(output_filename, "w", allowZip64=True) as zipf:
+        # Start compressing everything that needs it, stored members are written while the workers run
+        futures = {}
+        for idx, filename in enumerate(to_compress):
+            data_filename = os.path.join(tmp_folder, f"{idx}.deflate")
+            futures[filename] = (data_filename, executor.submit(_deflate_to_file, filename, data_filename, level))
+
+        for filename in filenames:
+            arcname = os.path.basename(filename)
+            zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+            if filename in futures:
+                data_filename, future = futures[filename]
+                crc, compress_size, seconds = future.result()
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.CRC = crc
+                zinfo.compress_size = compress_size
+                _zip_write_precompressed(zipf, zinfo, data_filename)
+                os.remove(data_filename)
+                _print_throughput(arcname, f"deflated to {compress_size / max(zinfo.file_size, 1) * 100:.0f}%", zinfo.file_size, seconds)
+            else:
+                start = time.perf_counter()
+                zipf.write(filename, arcname, compress_type=zipfile.ZIP_STORED)
+                _print_throughput(arcname, "stored", zinfo.file_size, time.perf_counter() - start)
+
+
+def build_tar_zst(output_filename, filenames, workers=4, level=3):
+    """
+    Stream files into a zstd compressed tar archive (named by their basename), zstd is fast enough that
+    incompressible data costs little. Needs the 'zstandard' package
+
+    :param output_filename: .tar.zst file to write
+    :param filenames: files to put in the archive
+    :param workers: Number of threads zstd compresses with
+    :param level: zstd compression level
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Writing a .tar.zst archive needs the 'zstandard' package, install with 'pip install zstandard'")
+
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+    with open(output_filename, "wb") as f, \
+            compressor.stream_writer(f) as zstd_stream, \
+            tarfile.open(fileobj=zstd_stream, mode="w|") as tar:
+        for filename in filenames:
+            arcname = os.path.basename(filename)
+            start = time.perf_counter()
+            tar.add(filename, arcname=arcname)
+            _print_throughput(arcname, "added", os.path.getsize(filename), time.perf_counter() - start)
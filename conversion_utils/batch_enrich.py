@@ -0,0 +1,217 @@
+import os
+import pickle
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from simply_nwb.pipeline import NWBSession
+from simply_nwb.pipeline.enrichments.saccades import PredictSaccadesEnrichment
+from simply_nwb.pipeline.enrichments.saccades.predict_gui import PredictedSaccadeGUIEnrichment
+from simply_nwb.pipeline.util.saccade_gui.data_generator import DirectionDataGenerator, EpochDataGenerator
+
+from conversion_utils.manifest import fingerprint_files
+from conversion_utils.pool import run_pooled
+from conversion_utils.staging import StagingCache, submit_staged
+
+# Enrichment for the sessions this worker process gets, set once by _init_worker
+_worker_enrichment = None
+
+# Files PredictedSaccadeGUIEnrichment loads its models from, or saves them to once trained, in the current folder
+SACCADE_MODEL_FILENAMES = [
+    "predict_gui_directional_model.pickle",
+    "predict_gui_temporal_epoch_regressor.pickle",
+    "predict_gui_temporal_epoch_transformer.pickle",
+    "predict_gui_nasal_epoch_regressor.pickle",
+    "predict_gui_nasal_epoch_transformer.pickle",
+]
+
+
+def _init_worker(enrichment_bytes):
+    # Runs once when each worker process starts, so the enrichment and its models are only unpickled once per worker
+    global _worker_enrichment
+    _worker_enrichment = pickle.loads(enrichment_bytes)
+
+
+def fit_enrichment(enrichment):
+    # PredictedSaccadeGUIEnrichment only loads its models (or has them labeled in the GUI and trains them) when it's
+    # run, so that would happen again for every file, and it keeps its training NWBs open which can't be pickled for
+    # worker processes. This does the loading or training once, the same way its _run does, closes the training NWBs
+    # and returns a PredictSaccadesEnrichment with the models, which enriches files the same way. Any other enrichment
+    # is returned as is
+    if not isinstance(enrichment, PredictedSaccadeGUIEnrichment):
+        return enrichment
+
+    if PredictedSaccadeGUIEnrichment._check_for_pretained_direction_model():
+        direction_cls = PredictedSaccadeGUIEnrichment.load_pretrained_direction_model()
+    else:
+        print("Collecting directional training data..")
+        waveforms, labels = enrichment._get_direction_gui_traindata()
+        waveforms, labels = DirectionDataGenerator(waveforms, labels).generate()
+        print("Training model..")
+        direction_cls = enrichment.get_pretrained_direction_model(waveforms, labels)
+
+    epoch_models = enrichment._check_for_epoch_models()
+    if not epoch_models:
+        print("Collecting epoch training data..")
+        waveforms, labels = enrichment._get_direction_gui_traindata()
+        epoch_waveforms, epochs, _ = enrichment._get_epoch_gui_traindata(waveforms, labels)
+        epoch_waveforms, epochs = EpochDataGenerator(epoch_waveforms, epochs).generate()
+        print("Training models..")
+        epoch_models = enrichment._get_epoch_models(epoch_waveforms, epochs)
+
+    for nwb_fp in enrichment.putat_nwb_fps:
+        nwb_fp.close()
+    enrichment.putat_nwb_fps = []
+    enrichment.putat_nwbs = []
+
+    return PredictSaccadesEnrichment(direction_cls, *epoch_models)
+
+
+def enrich_and_save(enrichment, input_filename, output_filename):
+    print(f"Loading '{input_filename}'..")
+    sess = NWBSession(input_filename)
+    print("Enriching..")
+    sess.enrich(enrichment)
+    print(f"Saving to file {output_filename}..")
+    sess.save(output_filename)
+
+
+def _enrich_pooled(input_filename, output_filename):
+    # Runs in a worker process, run_pooled() and submit_staged() catch what it raises
+    enrich_and_save(_worker_enrichment, input_filename, output_filename)
+
+
+def _run_staged(enrichment, enrichment_bytes, jobs, workers, staging_dir, prefetch_count, staging_max_bytes):
+    # Inputs are copied to staging_dir ahead of the workers, outputs are saved next to the staged copy and copied back
+    # in the background. Returns the list of (filename, error) that failed
+    outputs = dict(jobs)
+
+    def local_output(staged):
+        return os.path.join(staged.root, os.path.basename(outputs[staged.source]))
+
+    if enrichment_bytes is not None:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(enrichment_bytes,))
+        func, args_func = _enrich_pooled, lambda staged: (staged.local, local_output(staged))
+    else:  # Enrichment stays in this process, a thread still lets staging run alongside it
+        executor = ThreadPoolExecutor(max_workers=1)
+        func, args_func = enrich_and_save, lambda staged: (enrichment, staged.local, local_output(staged))
+
+    with StagingCache([input_filename for input_filename, _ in jobs], staging_dir, prefetch_count, staging_max_bytes) as stager:
+        with executor:
+            errored = submit_staged(
+                stager, executor, workers, func, args_func,
+                lambda staged, result: [(local_output(staged), outputs[staged.source])]
+            )
+
+    return errored + stager.write_errors
+
+
+def run_batch_enrichment(enrichment, jobs, workers=1, staging_dir=None, prefetch_count=2, staging_max_bytes=50 * 2 ** 30):
+    """
+    Enrich and save a batch of NWB files with an already created enrichment. Its models are loaded or trained once
+    here (see fit_enrichment()), then it's pickled once and handed to each worker process when it starts, so models
+    aren't retrained or reloaded for each file
+
+    :param enrichment: Enrichment to run on every file, ie a PredictedSaccadeGUIEnrichment
+    :param jobs: list of (input_filename, output_filename) tuples
+    :param workers: Number of files to enrich in parallel, 1 runs everything in this process
+    :param staging_dir: If set, inputs are copied into this local folder ahead of time and outputs are copied back in
+        the background, for when the inputs and outputs are on a slow network share
+    :param prefetch_count: Number of inputs to stage ahead of the workers
+    :param staging_max_bytes: Max size of staged inputs on local disk
+    :return: list of (filename, error) for the files that failed
+    """
+    errored = []
+    enrichment_bytes = None
+    enrichment = fit_enrichment(enrichment)
+
+    if workers > 1:
+        try:
+            enrichment_bytes = pickle.dumps(enrichment)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            print(f"WARNING: Enrichment can't be sent to worker processes, ignoring workers={workers} and running everything in this process. Error: {str(e)}")
+            workers = 1
+
+    if staging_dir is not None:
+        print(f"Enriching {len(jobs)} files with {workers} workers, staging in '{staging_dir}'")
+        errored = _run_staged(enrichment, enrichment_bytes, jobs, workers, staging_dir, prefetch_count, staging_max_bytes)
+    elif workers > 1:
+        print(f"Enriching {len(jobs)} files with {workers} workers")
+        finished = []
+
+        def on_done(job, result, err):
+            input_filename, _ = job
+            finished.append(input_filename)
+            if err is None:
+                print(f"[{len(finished)}/{len(jobs)}] Finished '{input_filename}'")
+            else:
+                errored.append((input_filename, err))
+                print(f"[{len(finished)}/{len(jobs)}] ERROR WITH FILE {input_filename}! Error: {err}")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(enrichment_bytes,)) as executor:
+            run_pooled(executor, _enrich_pooled, jobs, on_done)
+    else:
+        for done_count, (input_filename, output_filename) in enumerate(jobs):
+            try:
+                enrich_and_save(enrichment, input_filename, output_filename)
+                print(f"[{done_count + 1}/{len(jobs)}] Finished '{input_filename}'")
+            except Exception as e:
+                errored.append((input_filename, f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"))
+                print(f"[{done_count + 1}/{len(jobs)}] ERROR WITH FILE {input_filename}! Error: {str(e)}")
+
+    print("\nList of errored files and errors \n -----")
+    for input_filename, err in errored:
+        print(f"{input_filename} - {err}")
+    print("")
+
+    print("Summary \n ------")
+    print(f"Enriched: {len(jobs) - len(errored)}/{len(jobs)}")
+    print(f"Errored: {len(errored)}")
+
+    return errored
+
+
+def run_outdated_enrichment(enrichment, jobs, manifest, params, model_filenames=(), workers=1, staging_dir=None):
+    """
+    Like run_batch_enrichment(), but only for the outputs that are missing or out of date in the manifest, and records
+    the ones that were made. An output is out of date when its input file, params or any of the model files it's
+    predicted with changed (ie the models were retrained)
+
+    :param enrichment: Enrichment to run on every file, ie a PredictedSaccadeGUIEnrichment
+    :param jobs: list of (input_filename, output_filename) tuples, outputs are recorded under their filename
+    :param manifest: BuildManifest to check and record outputs in
+    :param params: JSON-able parameters the outputs are made with
+    :param model_filenames: model files every output depends on, ie SACCADE_MODEL_FILENAMES
+    :param workers: Number of files to enrich in parallel, 1 runs everything in this process
+    :param staging_dir: See run_batch_enrichment()
+    :return: list of (filename, error) for the files that failed
+    """
+    # Models have to exist before they can be fingerprinted
+    enrichment = fit_enrichment(enrichment)
+    model_inputs = fingerprint_files(model_filenames)
+
+    todo = []
+    job_inputs = {}
+    for input_filename, output_filename in jobs:
+        inputs = {**fingerprint_files([input_filename]), **model_inputs}
+        if os.path.exists(output_filename) and not manifest.is_recorded(output_filename):
+            # Made before there was a manifest, trust it's up to date with its input and the models as they are now
+            manifest.record(output_filename, inputs, params, [output_filename])
+            print(f"File exists, skipping '{output_filename}'..")
+            continue
+        reason = manifest.needs_rebuild(output_filename, inputs, params)
+        if reason is None:
+            print(f"File is up to date, skipping '{output_filename}'..")
+            continue
+        if os.path.exists(output_filename):
+            print(f"Regenerating '{output_filename}', {reason}")
+        todo.append((input_filename, output_filename))
+        job_inputs[input_filename] = inputs
+
+    errored = run_batch_enrichment(enrichment, todo, workers=workers, staging_dir=staging_dir)
+    # Failed enrichments are listed by input file, failed write backs from staging by output file. Either way it's not
+    # recorded, a stale output left behind by a failed write back would otherwise look up to date
+    errored_files = set(filename for filename, _ in errored)
+    for input_filename, output_filename in todo:
+        if input_filename not in errored_files and output_filename not in errored_files:
+            manifest.record(output_filename, job_inputs[input_filename], params, [output_filename])
+    return errored
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def load_spike_data(spike_clusters_filename, spike_times_filename):
+    # Memory map the kilosort output so nothing is read until it's needed
+    spike_clusters = np.load(str(spike_clusters_filename), mmap_mode="r").reshape(-1)
+    spike_times = np.load(str(spike_times_filename), mmap_mode="r").reshape(-1)
+    if spike_clusters.shape[0] != spike_times.shape[0]:
+        raise ValueError(f"spike_clusters.npy has '{spike_clusters.shape[0]}' entries but spike_times.npy has '{spike_times.shape[0]}'!")
+    return spike_clusters, spike_times
+
+
+def iter_cluster_spike_times(spike_clusters, spike_times):
+    # Yields (cluster_number, spike_times_for_cluster) in ascending cluster order, spike times keep their original order
+    # Sorts once by cluster so every cluster is a contiguous slice, instead of scanning all spikes once per cluster
+    if spike_clusters.shape[0] == 0:
+        return
+
+    if np.all(spike_clusters[1:] >= spike_clusters[:-1]):  # Already grouped, slice directly out of the source
+        sorted_clusters = spike_clusters
+        sorted_times = spike_times
+    else:
+        sort_keys = spike_clusters
+        if spike_clusters.min() >= 0 and spike_clusters.max() < 2 ** 16:
+            sort_keys = spike_clusters.astype(np.uint16)  # Stable sort of 16 bit ints is a linear time radix sort
+        order = np.argsort(sort_keys, kind="stable")
+        del sort_keys
+        sorted_clusters = spike_clusters[order]
+        sorted_times = spike_times[order]
+        del order
+
+    # Index of the first spike of each cluster, plus the end of the array
+    boundaries = np.concatenate(([0], np.flatnonzero(np.diff(sorted_clusters)) + 1, [sorted_clusters.shape[0]]))
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        yield sorted_clusters[start], sorted_times[start:stop]
@@ -0,0 +1,51 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from simply_nwb.transforms import labjack_load_file
+
+SEQUENCE_NUMBER_REGEX = re.compile(r"(\d+)(?!.*\d)")  # Last number in the filename
+
+
+def labjack_sequence_number(filename):
+    # Files are written like 'name_0.dat', 'name_1.dat', .. 'name_10.dat' so sort on the number, not the string
+    match = SEQUENCE_NUMBER_REGEX.search(os.path.basename(filename))
+    if match is None:
+        return -1
+    return int(match.group(1))
+
+
+def _load_labjack_dataframe(filename):
+    try:
+        return labjack_load_file(filename)["data"]
+    except Exception as e:
+        print(f"Failed parsing {filename}, Error '{str(e)}'skipping..")
+        return None
+
+
+def labjack_load_files(filenames, workers=4):
+    # Load a list of labjack .dat files in parallel into a single dataframe, in order of their sequence number
+    filenames = sorted(filenames, key=lambda f: (labjack_sequence_number(f), os.path.basename(f)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        labjack_datas = [d for d in executor.map(_load_labjack_dataframe, filenames) if d is not None]
+    if not labjack_datas:
+        raise ValueError("Labjack data is empty! Cannot continue")
+
+    columns = list(labjack_datas[0].columns)
+    for labjack_data in labjack_datas:
+        if list(labjack_data.columns) != columns:
+            raise ValueError(f"Labjack files have mismatched columns '{list(labjack_data.columns)}' expected '{columns}'")
+
+    # Fortran order so each column is contiguous, every file is copied in then dropped so only one full copy exists
+    total_rows = sum([d.shape[0] for d in labjack_datas])
+    combined = np.empty((total_rows, len(columns)), dtype=np.float64, order="F")
+    row_idx = 0
+    while labjack_datas:
+        labjack_data = labjack_datas.pop(0)
+        combined[row_idx:row_idx + labjack_data.shape[0]] = labjack_data.to_numpy(dtype=np.float64)
+        row_idx = row_idx + labjack_data.shape[0]
+        del labjack_data
+
+    return pd.DataFrame(combined, columns=columns, copy=False)
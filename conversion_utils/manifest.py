@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from conversion_utils.staging import file_checksum
+
+AUTOSAVE_SECONDS = 30  # Save the manifest at most this often while recording, and always when it's closed
+
+
+def fingerprint(stat_result):
+    # Cheap stand in for a file's contents, from os.stat or DirEntry.stat
+    return [stat_result.st_size, stat_result.st_mtime_ns]
+
+
+def fingerprint_files(filenames):
+    return {filename: fingerprint(os.stat(filename)) for filename in filenames}
+
+
+def _normalize(params):
+    # Params as they'd come back out of the JSON file, so they compare equal after a save and load
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+class BuildManifest(object):
+    def __init__(self, filename, hash_inputs=False):
+        """
+        Remembers, for each output a stage built, the input files it was built from (size and mtime, optionally a
+        checksum) and the parameters used, so like make only the outputs whose inputs or parameters changed are
+        rebuilt. Outputs are recorded under a target name, which can be the output filename or something like a
+        session id when the output filename isn't known ahead of time
+
+        :param filename: JSON file to keep the manifest in, created if it doesn't exist
+        :param hash_inputs: also record a checksum of every input. An input whose size or mtime changed but whose
+            checksum didn't (ie copied or touched) then doesn't cause a rebuild. Reads every input in full when recording
+        """
+        self._filename = filename
+        self._hash_inputs = hash_inputs
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+        self._targets = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                self._targets = json.load(f)["targets"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def save(self):
+        with self._lock:
+            tmp_filename = f"{self._filename}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp_filename, "w") as f:
+                json.dump({"targets": self._targets}, f)
+            os.replace(tmp_filename, self._filename)
+            self._last_save = time.monotonic()
+
+    def _input_changed(self, filename, recorded, current):
+        if recorded["fingerprint"] == current:
+            return False
+        if not self._hash_inputs or "checksum" not in recorded or file_checksum(filename) != recorded["checksum"]:
+            return True
+        recorded["fingerprint"] = current  # Same contents, don't hash it again next time
+        return False
+
+    def needs_rebuild(self, target, inputs, params=None):
+        """
+        Why target has to be rebuilt, or None if it's up to date
+
+        :param target: target name it was recorded under
+        :param inputs: dict of input filename to fingerprint, see fingerprint_files()
+        :param params: JSON-able parameters the output is made with
+        :return: str reason or None
+        """
+        with self._lock:
+            entry = self._targets.get(target)
+            if entry is None:
+                return "not built yet"
+            missing = [output for output in entry["outputs"] if not os.path.exists(output)]
+            if missing:
+                return f"output '{missing[0]}' is missing"
+            if entry["params"] != _normalize(params):
+                return "parameters changed"
+            if set(entry["inputs"]) != set(inputs):
+                return "input files added or removed"
+            for filename, current in inputs.items():
+                if self._input_changed(filename, entry["inputs"][filename], current):
+                    return f"input '{filename}' changed"
+        return None
+
+    def is_recorded(self, target):
+        return target in self._targets
+
+    def record(self, target, inputs, params=None, outputs=()):
+        """
+        Record that target was built from inputs, call once the outputs are written
+
+        :param target: target name
+        :param inputs: dict of input filename to fingerprint, taken before building so a change made while it was
+            building still triggers a rebuild next time
+        :param params: JSON-able parameters the output was made with
+        :param outputs: output filenames, target is rebuilt if any of them go missing
+        """
+        entry_inputs = {}
+        for filename, current in inputs.items():
+            entry_inputs[filename] = {"fingerprint": list(current)}
+            if self._hash_inputs:
+                entry_inputs[filename]["checksum"] = file_checksum(filename)
+
+        with self._lock:
+            self._targets[target] = {
+                "inputs": entry_inputs,
+                "params": _normalize(params),
+                "outputs": list(outputs)
+            }
+            autosave = time.monotonic() - self._last_save > AUTOSAVE_SECONDS
+        if autosave:
+            self.save()
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import time
+
+# A directory modified this recently (in seconds) might still change again within the same mtime tick, especially on
+# network shares with coarse timestamps, so it's rescanned next time instead of trusting its mtime
+MTIME_SETTLE_SECONDS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    session TEXT,
+    converted_at REAL,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_session ON files (session, converted_at);
+"""
+
+
+class NWBCatalog(object):
+    def __init__(self, db_filename, describe_func, extension=".nwb"):
+        """
+        SQLite catalog of the NWB files under a folder, so the folder doesn't have to be walked from scratch every
+        time. refresh() only lists the directories whose mtime changed since the last refresh, unchanged directories
+        just get their subdirectories from the catalog. Since a directory's mtime only changes when entries are added,
+        removed or renamed in it, a file rewritten in place is only picked up once its directory changes
+
+        :param db_filename: sqlite file to keep the catalog in, created if it doesn't exist
+        :param describe_func: func(path) -> (session, converted_at timestamp) for each file found. If it raises a
+            ValueError the file is kept in the catalog without a session and skipped by latest_per_session()
+        :param extension: file extension to catalog
+        """
+        self._describe = describe_func
+        self._extension = extension
+        self._conn = sqlite3.connect(db_filename)
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def _scan_dir(self, dirpath, mtime_ns):
+        # List a changed directory, replace its files in the catalog and return its subdirectories
+        subdirs = []
+        files = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(self._extension) and entry.is_file():
+                    try:
+                        session, converted_at = self._describe(entry.path)
+                    except ValueError as e:
+                        print(f"Can't parse '{entry.path}', skipping it. Error: {str(e)}")
+                        session, converted_at = None, None
+                    st = entry.stat()
+                    files.append((entry.path, dirpath, session, converted_at, st.st_size, st.st_mtime_ns))
+
+        self._conn.execute("DELETE FROM files WHERE dir = ?", (dirpath,))
+        self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", files)
+        self._conn.execute("UPDATE dirs SET mtime_ns = ? WHERE path = ?", (mtime_ns, dirpath))
+        return subdirs
+
+    def refresh(self, root):
+        """
+        Bring the catalog up to date with everything under root
+
+        :param root: folder to catalog
+        :return: (number of directories visited, number of directories that had to be listed)
+        """
+        root = os.path.normpath(root)
+        settled_ns = time.time_ns() - MTIME_SETTLE_SECONDS * 10 ** 9
+        visited = []
+        scanned_count = 0
+
+        with self._conn:  # One transaction, a refresh that fails partway leaves the catalog as it was
+            self._conn.execute("INSERT OR IGNORE INTO dirs VALUES (?, NULL, NULL)", (root,))
+            stack = [root]
+            while stack:
+                dirpath = stack.pop()
+                try:
+                    mtime_ns = os.stat(dirpath).st_mtime_ns
+                except FileNotFoundError:
+                    continue  # Removed, cleaned up below since it wasn't visited
+                visited.append((dirpath,))
+
+                row = self._conn.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (dirpath,)).fetchone()
+                if row is not None and row[0] == mtime_ns:
+                    stack.extend(r[0] for r in self._conn.execute("SELECT path FROM dirs WHERE parent = ?", (dirpath,)))
+                    continue
+
+                subdirs = self._scan_dir(dirpath, mtime_ns if mtime_ns < settled_ns else None)
+                scanned_count += 1
+                # Subdirectories that are still there keep their mtime, so they aren't relisted unless they changed
+                known = [r[0] for r in self._conn.execute("SELECT path FROM dirs WHERE parent = ?", (dirpath,))]
+                self._conn.executemany("DELETE FROM dirs WHERE path = ?", [(k,) for k in set(known) - set(subdirs)])
+                self._conn.executemany("INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)", [(s, dirpath) for s in subdirs])
+                stack.extend(subdirs)
+
+            # Drop everything under root that wasn't visited, its directory is gone
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS visited (path TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM visited")
+            self._conn.executemany("INSERT INTO visited VALUES (?)", visited)
+            under_root = (root, len(root) + 1, root + os.sep)
+            self._conn.execute("DELETE FROM dirs WHERE (path = ? OR substr(path, 1, ?) = ?) AND path NOT IN (SELECT path FROM visited)", under_root)
+            self._conn.execute("DELETE FROM files WHERE (dir = ? OR substr(dir, 1, ?) = ?) AND dir NOT IN (SELECT path FROM visited)", under_root)
+
+        return len(visited), scanned_count
+
+    def latest_per_session(self, root):
+        # Path of the most recently converted file of each session under root
+        root = os.path.normpath(root)
+        # SQLite takes the bare path column from the row with the MAX()
+        rows = self._conn.execute(
+            "SELECT path, MAX(converted_at) FROM files "
+            "WHERE session IS NOT NULL AND (dir = ? OR substr(dir, 1, ?) = ?) "
+            "GROUP BY session ORDER BY session",
+            (root, len(root) + 1, root + os.sep)
+        )
+        return [r[0] for r in rows]
@@ -0,0 +1,35 @@
+import traceback
+from concurrent.futures import as_completed
+
+
+def format_error(e):
+    return f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
+
+
+def call_catching(func, *args):
+    # Runs in a worker, returns (result, None) or (None, error string). Exceptions are converted to strings since not
+    # all of them can be pickled back from a worker process
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, format_error(e)
+
+
+def run_pooled(executor, func, jobs, done_func):
+    """
+    Run func(*args) for every args tuple in jobs on a pool, and call done_func(args, result, err) in this thread as
+    each one finishes. err is None or the error string, also when the pool itself broke (ie a worker process was killed
+    for running out of memory), so every job is always reported and a failure never stops the rest from being collected
+
+    :param executor: concurrent.futures executor
+    :param func: function to run, has to be picklable for a ProcessPoolExecutor
+    :param jobs: list of args tuples
+    :param done_func: func(args, result, err) called once for each job
+    """
+    futures = {executor.submit(call_catching, func, *args): args for args in jobs}
+    for future in as_completed(futures):
+        try:
+            result, err = future.result()
+        except Exception as e:
+            result, err = None, format_error(e)
+        done_func(futures[future], result, err)
@@ -0,0 +1,243 @@
+import collections
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future
+
+from conversion_utils.pool import call_catching, format_error
+
+COPY_BUFFER_BYTES = 16 * 2 ** 20  # Read and write in large sequential blocks, network shares are slow at small reads
+
+# source is the original path, root is the uuid folder it was staged into, local is the staged copy of source inside
+# root, size is the number of bytes staged, error is set (and local is None) if staging failed
+StagedPath = collections.namedtuple("StagedPath", ["source", "root", "local", "size", "error"])
+
+
+def file_checksum(filename, buffer_size=COPY_BUFFER_BYTES):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(buffer_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def copy_with_checksum(src, dst, buffer_size=COPY_BUFFER_BYTES, verify=True):
+    # Copy src to dst in large blocks, hashing what was read from src along the way. If verify is set, dst is read back
+    # and has to match, otherwise an IOError is raised. dst is written under a temp name so it's never left half written
+    hasher = hashlib.blake2b(digest_size=16)
+    tmp_dst = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(src, "rb") as fsrc, open(tmp_dst, "wb") as fdst:
+            for block in iter(lambda: fsrc.read(buffer_size), b""):
+                hasher.update(block)
+                fdst.write(block)
+        checksum = hasher.hexdigest()
+        if verify and file_checksum(tmp_dst, buffer_size) != checksum:
+            raise IOError(f"Checksum mismatch copying '{src}' to '{dst}'")
+        os.replace(tmp_dst, dst)
+    except BaseException:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+    return checksum
+
+
+def path_size(path, ignore=None):
+    # Total size in bytes of a file, or of every file under a directory. ignore works like shutil.copytree's
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        if ignore is not None:
+            ignored = ignore(dirpath, dirnames + filenames)
+            dirnames[:] = [d for d in dirnames if d not in ignored]
+            filenames = [f for f in filenames if f not in ignored]
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+class StagingCache(object):
+    def __init__(self, sources, cache_dir, prefetch_count=2, max_bytes=50 * 2 ** 30, verify=True, buffer_size=COPY_BUFFER_BYTES, ignore=None):
+        """
+        Copies input files (or whole session folders) from a slow network share to a local cache folder in the
+        background, ahead of when they are processed, and writes outputs back to the share in the background.
+        Iterate over it to get each StagedPath as soon as it's copied, process the local copy, write_back any outputs,
+        then release it to free up its space in the cache
+
+        :param sources: list of paths to stage, in order. Items can be a (path, relative_name) tuple to choose where
+            inside the staged root it goes (ie a session id like 20230921/unitME/session001), defaults to the basename
+        :param cache_dir: local folder to stage into, each source is put in its own uuid folder under it
+        :param prefetch_count: max number of staged paths waiting to be picked up
+        :param max_bytes: max total size of staged inputs that haven't been released, a single source bigger than this
+            is staged by itself
+        :param verify: read back every copy (in and out) and check it against the checksum of what was read
+        :param buffer_size: block size for reads and writes
+        :param ignore: for folder sources, func(dirpath, names) -> names not to stage, like shutil.ignore_patterns()
+        """
+        self._sources = [source if isinstance(source, tuple) else (source, os.path.basename(os.path.normpath(source))) for source in sources]
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._verify = verify
+        self._buffer_size = buffer_size
+        self._ignore = ignore
+
+        self._staged = queue.Queue(maxsize=max(prefetch_count, 1))
+        self._staged_bytes = 0
+        self._budget_cond = threading.Condition()
+        self._stage_thread = threading.Thread(target=self._stage_all, daemon=True)
+
+        # Write backs and releases go through the same queue, so a staged folder is only deleted after the outputs
+        # that were queued from it are copied out
+        self._writes = queue.Queue()
+        self._write_thread = threading.Thread(target=self._write_all, daemon=True)
+        self.write_errors = []  # (remote_filename, error) for write backs that failed
+
+    def start(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._stage_thread.start()
+        self._write_thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _copy(self, src, dst):
+        return copy_with_checksum(src, dst, self._buffer_size, self._verify)
+
+    def _stage_all(self):
+        for source, relative_name in self._sources:
+            root = os.path.join(self._cache_dir, str(uuid.uuid4()))
+            size = 0
+            try:
+                size = path_size(source, self._ignore)
+                with self._budget_cond:  # Wait for enough room in the cache
+                    self._budget_cond.wait_for(lambda: self._staged_bytes == 0 or self._staged_bytes + size <= self._max_bytes)
+                    self._staged_bytes += size
+
+                local = os.path.join(root, relative_name)
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                print(f"Staging '{source}'..")
+                if os.path.isdir(source):
+                    shutil.copytree(source, local, copy_function=self._copy, ignore=self._ignore)
+                else:
+                    self._copy(source, local)
+                self._staged.put(StagedPath(source, root, local, size, None))
+            except Exception as e:
+                self._staged.put(StagedPath(source, root, None, size, e))
+        self._staged.put(None)  # Done
+
+    def __iter__(self):
+        # Yields a StagedPath for each source as soon as it's staged, in order
+        while True:
+            staged = self._staged.get()
+            if staged is None:
+                return
+            yield staged
+
+    def write_back(self, local_filename, remote_filename):
+        # Queue a local output file to be copied to remote_filename in the background
+        self._writes.put((local_filename, remote_filename))
+
+    def release(self, staged):
+        # Queue the staged copy to be deleted (after any write backs queued before this) and free up its space
+        self._writes.put(staged)
+
+    def _write_all(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            if isinstance(item, StagedPath):
+                shutil.rmtree(item.root, ignore_errors=True)
+                with self._budget_cond:
+                    self._staged_bytes -= item.size
+                    self._budget_cond.notify_all()
+                continue
+
+            local_filename, remote_filename = item
+            try:
+                print(f"Writing back '{remote_filename}'..")
+                self._copy(local_filename, remote_filename)
+            except Exception as e:
+                print(f"Error writing back '{remote_filename}' Error: {str(e)}")
+                self.write_errors.append((remote_filename, e))
+
+    def close(self):
+        # Wait for every queued write back and release to finish, returns the write back errors
+        if self._write_thread.is_alive():
+            self._writes.put(None)
+            self._write_thread.join()
+        return self.write_errors
+
+
+def submit_staged(stager, executor, max_pending, func, args_func, done_func):
+    """
+    Hand each staged path to a pool as soon as it's staged, without having more than max_pending running at once so
+    the rest stay queued in the stager. Once a path is done its outputs are written back and it's always released,
+    whether staging it, running func or done_func failed
+
+    :param stager: started StagingCache
+    :param executor: concurrent.futures executor
+    :param max_pending: max number of submitted paths that haven't finished
+    :param func: function to run for each staged path, has to be picklable for a ProcessPoolExecutor
+    :param args_func: func(staged) -> tuple of args to call func with
+    :param done_func: func(staged, result) called with what func returned once it succeeded, returns the list of
+        (local_filename, remote_filename) outputs to write back. Called from a background thread
+    :return: list of (source, error) for the paths that failed
+    """
+    errored = []
+    finished = []
+    # A slot is held from submitting a path until finish() is done with it. Waiting on the futures instead isn't
+    # enough, their done callbacks can still be running after wait() returns
+    slots = threading.Semaphore(max_pending)
+
+    def finish(staged, future):
+        # Anything raised here would be swallowed by the executor, so it's all caught and counted as an error
+        try:
+            if future is None:
+                err = f"{type(staged.error).__name__}: {str(staged.error)}"
+            else:
+                result, err = future.result()
+            if err is None:
+                for local_filename, remote_filename in done_func(staged, result):
+                    stager.write_back(local_filename, remote_filename)
+        except Exception as e:
+            err = format_error(e)
+        finally:
+            stager.release(staged)  # Otherwise staging would wait on its space forever
+
+        finished.append(staged.source)
+        if err is None:
+            print(f"[{len(finished)}/{len(stager)}] Finished '{staged.source}'")
+        else:
+            errored.append((staged.source, err))
+            print(f"[{len(finished)}/{len(stager)}] ERROR WITH {staged.source}! Error: {err}")
+        if future is not None:
+            slots.release()
+
+    for staged in stager:
+        if staged.error is not None:
+            finish(staged, None)
+            continue
+
+        slots.acquire()
+        try:
+            future = executor.submit(call_catching, func, *args_func(staged))
+        except Exception as e:  # ie BrokenProcessPool, nothing can be submitted anymore once a worker died
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda f, s=staged: finish(s, f))
+
+    for _ in range(max_pending):  # Wait for everything submitted to finish
+        slots.acquire()
+    return errored
@@ -0,0 +1,60 @@
+import re
+
+import numpy as np
+
+# Split on commas that aren't inside of parenthesis, ex 'Event (1=grating, 2=motion), Phase' -> ['Event (..)', 'Phase']
+COLUMN_SPLIT_REGEX = re.compile(r",(?![^()]*\))")
+HEADER_SEPARATOR = "------------"
+
+
+def parse_metadata_columns(cols_str):
+    if cols_str.count("(") != cols_str.count(")"):
+        raise ValueError("String didn't have a terminating ')'!")
+    cols = [c.strip() for c in COLUMN_SPLIT_REGEX.split(cols_str)]
+    return [c for c in cols if c]
+
+
+def parse_metadata_file(filename, dtype=np.float64):
+    # Parse a metadata .txt file like driftingGratingMetadata.txt which looks like
+    # Key: value
+    # Columns: Col1, Col2 (with, commas), ..
+    # ------------
+    # 1.0, 2.0, ..
+    # into a dict of {"Key": "Metavalue", .., "MetaCol1": [1.0, ..], "Col2 (with, commas)": .., ..}
+    # Columns are lists like they've always been, dict_to_dyn_tables would make an array into a single row
+    with open(filename, "r") as fp:
+        data = fp.read().splitlines()
+
+    processed = {}
+    # Parse Header
+    file_line_idx = 0
+    while True:
+        if file_line_idx >= len(data):
+            raise ValueError(f"Could not process '{filename}', couldn't find the '{HEADER_SEPARATOR}' header separator")
+        line = data[file_line_idx]
+        if line.startswith(HEADER_SEPARATOR):
+            break
+        sep_idx = line.find(":")
+        key = line[:sep_idx].strip()
+        val = line[sep_idx + 1:].strip()
+        processed[key] = "Meta" + val  # prepend meta to ensure no collisions
+        file_line_idx = file_line_idx + 1
+    if "Columns" not in processed:
+        raise ValueError(f"Could not process '{filename}', couldn't find Column names")
+
+    # Column names are parsed from the stored value, so the first column keeps the 'Meta' prefix like it always has
+    cols = parse_metadata_columns(processed["Columns"])
+
+    body = data[file_line_idx + 1:]
+    if body:
+        # Check every line has the right number of columns before parsing
+        col_counts = np.char.count(np.array(body), ",") + 1
+        bad_lines = np.where(col_counts != len(cols))[0]
+        if bad_lines.size:
+            raise ValueError(f"Invalid number of columns for line '{body[bad_lines[0]]}' Doesnt match up with expected columns")
+        values = np.loadtxt(body, delimiter=",", dtype=dtype, ndmin=2)
+    else:
+        values = np.empty((0, len(cols)), dtype=dtype)
+
+    processed.update({col: values[:, col_idx].tolist() for col_idx, col in enumerate(cols)})
+    return processed
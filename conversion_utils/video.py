@@ -0,0 +1,49 @@
+import imageio.v3 as iio
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import DataChunkIterator
+from pynwb.image import ImageSeries
+
+DEFAULT_BUFFER_FRAMES = 200  # Number of decoded frames held in memory at once
+
+
+def mp4_frame_count_and_shape(filename):
+    # Frame count comes from the container metadata, the whole video isn't decoded
+    try:
+        props = iio.improps(filename, plugin="pyav")
+    except Exception as e:
+        raise ValueError(f"Unable to open video file '{filename}' Error: {str(e)}")
+    return props.shape[0], props.shape[1:]
+
+
+def mp4_iter_frames(filename):
+    # Decode one RGB frame at a time (same as mp4_read_data), DataChunkIterator will buffer them into chunks
+    yield from iio.imiter(filename, plugin="pyav")
+
+
+def mp4_add_as_streamed_acquisition(nwbfile, name, filename, sampling_rate, description, buffer_frames=DEFAULT_BUFFER_FRAMES, compression="gzip"):
+    # Like SimpleNWB.mp4_add_as_acquisition, but frames are decoded and written to the NWB in chunks of buffer_frames
+    # while the file is being written instead of the whole video being read into memory up front
+    frame_count, frame_shape = mp4_frame_count_and_shape(filename)
+
+    data = DataChunkIterator(
+        data=mp4_iter_frames(filename),
+        maxshape=(None, *frame_shape),
+        dtype=np.dtype(np.uint8),
+        buffer_size=buffer_frames
+    )
+    image_series = ImageSeries(
+        name=name,
+        data=H5DataIO(
+            data=data,
+            compression=compression,
+            chunks=(1, *frame_shape)  # One frame per chunk so single frames can be read without decompressing others
+        ),
+        description=description,
+        unit="n.a.",
+        rate=sampling_rate,
+        starting_time=0.0,
+        comments=f"Streamed from '{filename}', expected '{frame_count}' frames"
+    )
+    nwbfile.add_acquisition(image_series)
+    return image_series
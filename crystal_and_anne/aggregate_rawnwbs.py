@@ -1,50 +1,49 @@
-import glob
-import json
+import argparse
 import pendulum
 import os
-import zipfile
+import sys
+
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.archive import build_tar_zst, build_zip
+from conversion_utils.nwb_catalog import NWBCatalog
 
 
 ROOT_FOLDER_TO_SEARCH = "/media/polegpolskylab/VIDEO-DATA-02/CompressedDataLocal"
+CATALOG_FILENAME = "nwb_catalog.sqlite"  # Remembers what was found last run, so only changed folders are listed again
+
+
+def describe_nwb(nwb):
+    # Session is everything before the first '-' of the path under the root folder, the conversion date is parsed out
+    # of the filename
+    session = nwb[len(ROOT_FOLDER_TO_SEARCH):].split("-")[0]
+    filename = os.path.basename(nwb)
+    split = filename.split("-")[2:]
+    date = "-".join(split)
+    date = date[:-len(".nwb")]
+    date = pendulum.from_format(date, "M-D_H-mm-s")
+    return session, date.timestamp()
+
 
+def main(workers=4, archive_format="zip"):
+    with NWBCatalog(CATALOG_FILENAME, describe_nwb) as catalog:
+        visited_count, scanned_count = catalog.refresh(ROOT_FOLDER_TO_SEARCH)
+        print(f"Refreshed NWB catalog, listed {scanned_count} changed of {visited_count} folders")
+        files_to_copy = catalog.latest_per_session(ROOT_FOLDER_TO_SEARCH)
 
-def main():
-    nwbs = glob.glob(f"{ROOT_FOLDER_TO_SEARCH}/**/*.nwb", recursive=True)
-
-    grouped = {}
-    for nwb in nwbs:
-        split = nwb[len(ROOT_FOLDER_TO_SEARCH):].split("-")
-        if split[0] in grouped:
-            grouped[split[0]].append(nwb)
-        else:
-            grouped[split[0]] = [nwb]
-
-    # print("Grouped")
-    # print(json.dumps(grouped, indent=2))
-
-    latest = []
-    for prefix, matches in grouped.items():
-        dates = []
-        for match in matches:
-            # Parse out date from the filename
-            filename = os.path.basename(match)
-            split = filename.split("-")[2:]
-            date = "-".join(split)
-            date = date[:-len(".nwb")]
-            date = pendulum.from_format(date, "M-D_H-mm-s")
-            dates.append([match, date.timestamp()])
-        s = sorted(dates, key=lambda x: x[1])
-        # print("---\n")
-        # print(json.dumps(s, indent=2))
-        latest.append(s[-1])
-
-    files_to_copy = [l[0] for l in latest]
-    zipf = zipfile.ZipFile("NWBs.zip", "w", zipfile.ZIP_DEFLATED)
-    for file in files_to_copy:
-        print(f"Writing {file} to zipfile..")
-        zipf.write(file, arcname=os.path.basename(file))
-    zipf.close()
+    if archive_format == "tar.zst":
+        build_tar_zst("NWBs.tar.zst", files_to_copy, workers=workers)
+    else:
+        build_zip("NWBs.zip", files_to_copy, workers=workers)
 
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(
+        prog="aggregate_rawnwbs.py",
+        description="Archives the latest NWB file of each session"
+    )
+    arg_parser.add_argument("-w", "--workers", type=int, default=4, help="Number of files to compress in parallel")
+    arg_parser.add_argument("-f", "--format", choices=["zip", "tar.zst"], default="zip", help="Write NWBs.zip, or stream a NWBs.tar.zst (needs the 'zstandard' package)")
+    args = arg_parser.parse_args()
+
+    main(workers=args.workers, archive_format=args.format)
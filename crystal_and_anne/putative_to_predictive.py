@@ -1,15 +1,23 @@
+import argparse
 import glob
 import os
 import random
+import sys
 
 import pendulum
 from pynwb import NWBHDF5IO
 from pynwb.file import Subject
 from simply_nwb import SimpleNWB
-from simply_nwb.pipeline import NWBSession
 from simply_nwb.pipeline.enrichments.saccades import PutativeSaccadesEnrichment
 from simply_nwb.pipeline.enrichments.saccades.predict_gui import PredictedSaccadeGUIEnrichment
 
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.batch_enrich import SACCADE_MODEL_FILENAMES, fit_enrichment, run_outdated_enrichment
+from conversion_utils.manifest import BuildManifest
+
+MANIFEST_FILENAME = "manifest.json"  # Kept in the output folder, records which putative NWB and models each predictive NWB was made from
+
 
 def select_putative_training_nwbs(list_of_nwbs, doskip):
     if doskip:
@@ -18,7 +26,7 @@ def select_putative_training_nwbs(list_of_nwbs, doskip):
     random.shuffle(list_of_nwbs)
     return list_of_nwbs[:5]
 
-def main():
+def main(workers=1, staging_dir=None):
     # Get the filenames for the timestamps.txt and dlc CSV
     input_folder = "C:\\Users\\minjarec\\OneDrive - The University of Colorado Denver\\Documents\\putative_nwbs"
     output_folder = "C:\\Users\\minjarec\\OneDrive - The University of Colorado Denver\\Documents\\predict_nwbs"
@@ -27,23 +35,31 @@ def main():
 
     files = glob.glob(os.path.join(input_folder, "**.nwb"))
     print("Creating enrichment..")
-    enrich = PredictedSaccadeGUIEnrichment(200, select_putative_training_nwbs(files, skip_load_trainingdata), num_training_samples, {})
-
-    for file in files:
-        savefn = os.path.join(output_folder, f"predictive-{os.path.basename(file)[:-len('.nwb')]}.nwb")
-        if os.path.exists(savefn):
-            print(f"File exists, skipping '{savefn}'..")
-            continue
-        print(f"Loading '{file}'..")
-        sess = NWBSession(file)
+    # Models are loaded (or labeled and trained) once here, the fitted models are then shared with every worker
+    enrich = fit_enrichment(PredictedSaccadeGUIEnrichment(200, select_putative_training_nwbs(files, skip_load_trainingdata), num_training_samples, {}))
+
+    # Bump the version to regenerate everything
+    params = {"enrichment": "PredictedSaccadeGUIEnrichment", "num_training_samples": num_training_samples, "version": 1}
+
+    with BuildManifest(os.path.join(output_folder, MANIFEST_FILENAME)) as manifest:
+        jobs = []
+        for file in files:
+            savefn = os.path.join(output_folder, f"predictive-{os.path.basename(file)[:-len('.nwb')]}.nwb")
+            jobs.append((file, savefn))
+
         # Take our putative saccades and do the actual prediction for the start, end time, and time location
-        print("Enriching..")
-        sess.enrich(enrich)
-        print("Saving to NWB")
-        print(f"Saving to file {savefn}..")
-        sess.save(savefn)  # Save as our finalized session, ready for analysis
-        tw = 2
+        # Outputs are also remade when the models in predict_gui_*.pickle change
+        run_outdated_enrichment(enrich, jobs, manifest, params, SACCADE_MODEL_FILENAMES, workers=workers, staging_dir=staging_dir)
+    tw = 2
 
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(
+        prog="putative_to_predictive.py",
+        description="Predicts saccades for putative NWB files"
+    )
+    arg_parser.add_argument("-w", "--workers", type=int, default=1, help="Number of files to enrich in parallel")
+    arg_parser.add_argument("-s", "--staging-dir", default=None, help="Local folder to copy files into before enriching them")
+    args = arg_parser.parse_args()
+
+    main(workers=args.workers, staging_dir=args.staging_dir)
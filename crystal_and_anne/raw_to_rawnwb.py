@@ -1,5 +1,8 @@
+import argparse
 import datetime
 import glob
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from pendulum.parsing import ParserError
 from dict_plus.utils.simpleflatten import SimpleFlattener
@@ -10,17 +13,31 @@ from simply_nwb.transforms import csv_load_dataframe_str, yaml_read_file
 from simply_nwb import SimpleNWB
 from pynwb.file import Subject
 import pendulum
+import itertools
 import os
+import shutil
+import numpy as np
+import pandas as pd
 
 from simply_nwb.util import panda_df_to_list_of_timeseries
 
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.manifest import BuildManifest, fingerprint
+from conversion_utils.pool import run_pooled
+from conversion_utils.stim_metadata import parse_metadata_file
+from conversion_utils.staging import StagingCache, submit_staged
+from conversion_utils.video import mp4_add_as_streamed_acquisition
+
 # Simply-NWB Package Documentation
 # https://simply-nwb.readthedocs.io/en/latest/index.html
 
 
 # Constants at the top of the file for things you might want to change for
 # different NWBs for flexibility
-SKIP_EXISTING = True  # If true, skip folders that already have an NWB in them
+SKIP_EXISTING = True  # If true, skip folders with an NWB that's up to date with the files in the folder
+MANIFEST_FILENAME = "raw_to_rawnwb_manifest.json"  # Kept in the data folder, records what each session's NWB was made from
+CONVERTER_VERSION = 1  # Bump after changing how sessions are converted, to reconvert every session
 
 INSTITUTION: str = "CU Anschutz"
 
@@ -35,6 +52,11 @@ EXPERIMENT_KEYWORDS: [str] = ["mouse", "saccade", "CNO", "dreadds", "pitx2", "dr
 EXPERIMENT_RELATED_PUBLICATIONS = None  # optional
 
 MP4_SAMPLING_RATE: float = 200.0
+EMBED_VIDEOS = False  # If true, stream the videos into the NWB instead of linking to them as external files
+MP4_BUFFER_FRAMES = 200  # Number of frames held in memory at once when embedding videos
+STAGING_PREFETCH = 2  # When staging, number of session folders to copy to local disk ahead of the workers
+STAGING_MAX_BYTES = 200 * 2 ** 30  # When staging, max total size of staged session folders on local disk
+DISCOVERY_THREADS = 16  # Number of folders to list at once when looking for sessions, hides the NAS round trip latency
 
 MOUSE_DATA = {  # TODO ADD MORE MICE AND UPDATE BIRTHDAYS AND SEXES?
     "dcm10": {
@@ -115,6 +137,9 @@ STIM_CSVS = {
     # }
 }
 
+DLC_CHUNK_ROWS = 50000  # Number of DLC CSV rows to parse at a time
+DLC_DTYPE = np.float64  # Could use np.float32 to halve memory usage on very long sessions
+
 # TODO Fill these out!
 RESPONSE_SAMPLING_RATE = MP4_SAMPLING_RATE
 RESPONSE_DESCRIPTION = "description about the processed response"
@@ -144,9 +169,21 @@ def process_labjack(nwbfile, foldername):
     tw = 2
 
 
-def process_video(nwbfile, filename, cam_name, video_description):
+def process_video(nwbfile, filename, cam_name, video_description, session_folder=None):
     print(f"Processing '{cam_name}' video")
 
+    if EMBED_VIDEOS:
+        mp4_add_as_streamed_acquisition(
+            nwbfile,
+            name=cam_name,
+            filename=filename if session_folder is None else os.path.join(session_folder, filename),
+            sampling_rate=MP4_SAMPLING_RATE,
+            description=video_description,
+            buffer_frames=MP4_BUFFER_FRAMES
+        )
+        print("Video processing complete")
+        return
+
     video_series = ImageSeries(
         name=cam_name,
         external_file=[filename],
@@ -161,71 +198,7 @@ def process_video(nwbfile, filename, cam_name, video_description):
 
 
 def process_drifting_meta(nwbfile, filename):
-    fp = open(filename, "r")
-    processed = {}
-
-    data = fp.readlines()
-    # Parse Header
-    file_line_idx = 0
-    while True:
-        line = data[file_line_idx]
-        if line.startswith("------------"):
-            break
-        sep_idx = line.find(":")
-        key = line[:sep_idx].strip()
-        val = line[sep_idx + 1:].strip()
-        processed[key] = "Meta" + val  # prepend meta to ensure no collisions
-        file_line_idx = file_line_idx + 1
-    if "Columns" not in processed:
-        raise ValueError("Could not process driftingGratingMetadata.txt, couldn't find Column names")
-
-    cols = []
-    cols_str = processed["Columns"]
-    starting_idx = 0
-    range_len = 0
-    str_idx = 0
-    while True:
-        char = cols_str[str_idx]
-        if char == "(":
-            while True:
-                str_idx = str_idx + 1
-                range_len = range_len + 1
-                if cols_str[str_idx] == ")":
-                    break
-                if str_idx == 10000:
-                    raise ValueError("String didn't have a terminating ')'! (or too long)")
-            str_idx = str_idx + 1  # Increment past the ')'
-            range_len = range_len + 1
-
-            if str_idx >= len(cols_str):  # ) is the end of the string
-                char = ""
-            else:
-                char = cols_str[str_idx]
-
-        if char == "," or str_idx + 1 >= len(cols_str):
-            cols.append(cols_str[starting_idx:starting_idx + range_len])
-            starting_idx = str_idx + 1
-            range_len = 0
-            if str_idx + 1 >= len(cols_str):
-                break
-        range_len = range_len + 1
-        str_idx = str_idx + 1
-
-    # Clean up the header strings by removing whitespace and removing trailing ','
-    cols = [c.strip() for c in cols]
-    cols = [c[:-1] if c.endswith(",") else c for c in cols]
-
-    file_line_idx = file_line_idx + 1
-    drift_data = data[file_line_idx:]
-
-    processed.update({c: [] for c in cols})
-
-    for drift_line in drift_data:
-        split = drift_line.split(",")
-        if len(split) != len(cols):
-            raise ValueError(f"Invalid number of columns for line '{split}' Doesnt match up with expected columns")
-        for col_idx, col in enumerate(cols):
-            processed[col].append(float(split[col_idx].strip()))
+    processed = parse_metadata_file(filename)
 
     SimpleNWB.processing_add_dict(
         nwbfile,
@@ -237,6 +210,62 @@ def process_drifting_meta(nwbfile, filename):
     )
 
 
+def _count_lines(filename, block_size=2 ** 20):
+    # Count the lines in a file without loading it all into memory
+    count = 0
+    last_block = b""
+    with open(filename, "rb") as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            count = count + block.count(b"\n")
+            last_block = block
+    if last_block and not last_block.endswith(b"\n"):
+        count = count + 1  # Last line doesn't have a trailing newline
+    return count
+
+
+def read_dlc_csv(filename, chunk_rows=DLC_CHUNK_ROWS, dtype=DLC_DTYPE):
+    # Read a DeepLabCut CSV into a dict of {header: column array}, the header is 3 lines like
+    # scorer,<resnet name>,<resnet name>,..
+    # bodyparts,center,center,..
+    # coords,x,y,..
+    # which are combined into 'bodyparts_coords', 'center_x', 'center_y', ..
+    max_rows = _count_lines(filename) - 3
+
+    with open(filename, "r") as fp:
+        fp.readline()  # First line is not important, just 'scorer,<resnet name>*6'
+        col_prefixes = fp.readline().split(",")  # Next line is the prefixes of the columns
+        col_suffixes = fp.readline().split(",")
+        if len(col_prefixes) != len(col_suffixes):
+            raise ValueError(f"DLC CSV '{filename}' header rows have a different number of columns!")
+        headers = [f"{col_prefixes[i].strip()}_{col_suffixes[i].strip()}" for i in range(0, len(col_prefixes))]
+
+        # First column ('bodyparts_coords') is the integer frame index, the rest are coordinates and likelihoods
+        # Columns are stored (col, row) so that each column is a contiguous view
+        frame_idxs = np.empty(max(max_rows, 0), dtype=np.int64)
+        data = np.empty((len(headers) - 1, max(max_rows, 0)), dtype=dtype)
+        row_idx = 0
+        while True:
+            lines = list(itertools.islice(fp, chunk_rows))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]  # Skip blank lines like loadtxt does, so the rows line up
+            if not lines:
+                continue
+            chunk = np.loadtxt(lines, delimiter=",", dtype=dtype, ndmin=2)
+            if chunk.shape[1] != len(headers):
+                raise ValueError(f"DLC CSV '{filename}' has rows with '{chunk.shape[1]}' columns, expected '{len(headers)}'")
+            frame_idxs[row_idx:row_idx + chunk.shape[0]] = np.array([line[:line.find(",")] for line in lines]).astype(np.int64)
+            data[:, row_idx:row_idx + chunk.shape[0]] = chunk[:, 1:].T
+            row_idx = row_idx + chunk.shape[0]
+
+    columns = {headers[0]: frame_idxs[:row_idx]}
+    columns.update({header: data[col_idx, :row_idx] for col_idx, header in enumerate(headers[1:])})
+    return columns
+
+
 def process_eyetracking(nwbfile, session_folder):
     # STIM_CSVS
     for name, stim_data in STIM_CSVS.items():
@@ -246,16 +275,6 @@ def process_eyetracking(nwbfile, session_folder):
         if not results:
             raise ValueError(f"Unable to find any files matching '{fullpath}'")
         results = results[0]
-        io = open(results, "r")
-        lines = io.readlines()
-
-        lines.pop(0)  # First line is not important, just 'scorer,<resnet name>*6'
-        col_prefixes = lines.pop(0).split(",")  # Next line is the prefixes of the columns
-        col_suffixes = lines.pop(0).split(",")
-
-        # Combine the column names, insert back into data list
-        headers = [f"{col_prefixes[i].strip()}_{col_suffixes[i].strip()}" for i in range(0, len(col_prefixes))]
-        lines.insert(0, ",".join(headers))
 
         # Create the module to add the data to
         response_processing_module = nwbfile.create_processing_module(
@@ -263,8 +282,8 @@ def process_eyetracking(nwbfile, session_folder):
             description="Processed eyetracking data for {}".format(name)
         )
 
-        # Load CSV into a dataframe, convert to TimeSeries
-        response_df = csv_load_dataframe_str("\n".join(lines))
+        # Load CSV columns straight into a dataframe, convert to TimeSeries
+        response_df = pd.DataFrame(read_dlc_csv(results), copy=False)
         response_ts = panda_df_to_list_of_timeseries(
             response_df,
             measured_unit_list=stim_data["units"],
@@ -363,7 +382,8 @@ def process_session(prefix, session_id, session_desc, mouse_name, mouse_weight):
             nwbfile,
             f"{file_prefix}_{eyecam}{video_suffix}",
             f"{eyecam}",
-            f"{eyecam} video of eye"
+            f"{eyecam} video of eye",
+            session_folder=session_path_prefix
         )
 
         # Timestamps
@@ -386,7 +406,8 @@ def process_session(prefix, session_id, session_desc, mouse_name, mouse_weight):
         nwbfile,
         f"{probe_video_name}",
         "ProbeVideo",
-        "Drifting grating of the probe stimulus"
+        "Drifting grating of the probe stimulus",
+        session_folder=session_path_prefix
     )
 
     # Process driftingGratingMetdata
@@ -429,6 +450,7 @@ def process_session(prefix, session_id, session_desc, mouse_name, mouse_weight):
     # io = NWBHDF5IO(nwb_filename)
     # ff = io.read()
     tw = 2
+    return nwb_filename
 
 
 def parse_mousedata(mousedata_filepath):
@@ -448,61 +470,198 @@ def parse_mousedata(mousedata_filepath):
     return name, desc, weight
 
 
-def mass_process_sessions(root_path):
-    folders = os.listdir(root_path)
+def _scan_date_folder(root_path, folder):
+    # Session folders in a date folder, one listing of its unitME folder
+    unit_path = os.path.join(root_path, folder, "unitME")
+    try:
+        with os.scandir(unit_path) as it:
+            return [(folder, entry.name) for entry in it if entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return [(folder, None)]
+
+
+def _scan_session_folder(root_path, folder, sess):
+    # One listing of the session folder is enough to find its NWBs, its input files and their fingerprints, and
+    # mousedata.txt. Returns (nwb filenames, {input filename: fingerprint}, (name, desc, weight) or None if
+    # mousedata.txt is missing)
+    path = os.path.join(root_path, folder, "unitME", sess)
+    nwbs = []
+    inputs = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith(".nwb"):
+                if not entry.name.startswith("."):  # Same as glob("*.nwb")
+                    nwbs.append(entry.path)
+            elif entry.is_file():
+                inputs[entry.path] = fingerprint(entry.stat())
+    mousedata = os.path.join(path, "mousedata.txt")
+    if mousedata not in inputs:
+        return nwbs, inputs, None
+    return nwbs, inputs, parse_mousedata(mousedata)
+
+
+def session_params(session_data):
+    # Everything besides the session folder's files that goes into a session's NWB, a change reconverts it
+    return {
+        "converter_version": CONVERTER_VERSION,
+        "session_description": session_data["session_description"],
+        "mouse_name": session_data["mouse_name"],
+        "mouse_weight": session_data["mouse_weight"],
+        "mouse_data": MOUSE_DATA.get(session_data["mouse_name"]),
+        "embed_videos": EMBED_VIDEOS,
+        "mp4_sampling_rate": MP4_SAMPLING_RATE,
+        "stim_csvs": STIM_CSVS,
+        "dlc_dtype": np.dtype(DLC_DTYPE).name
+    }
+
+
+def mass_process_sessions(root_path, manifest, threads=DISCOVERY_THREADS):
+    # Date folders are listed in parallel, then every session folder is, each listing is a round trip to the NAS so
+    # they're overlapped in threads. Results are gathered in listing order, same as listing one folder at a time.
+    # Sessions are skipped if the manifest says their NWB is up to date, the input fingerprints are kept in each
+    # session's data so they can be recorded once it's converted
+    with os.scandir(root_path) as it:
+        folders = [entry.name for entry in it if entry.is_dir()]
+
     failed_mousedata = []
     to_process = {}
-    for folder in folders:
-        sessions = os.listdir(os.path.join(root_path, folder, "unitME"))
-        for sess in sessions:
-            path = os.path.join(root_path, folder, "unitME", sess)
-            if not os.path.isdir(path):
-                continue
-            mouse_data = os.path.join(path, "mousedata.txt")
-            g = glob.glob(os.path.join(path, "*.nwb"))
-            if g and SKIP_EXISTING:
-                print(f"Already found NWB in folder {folder}/{sess}, Skipping")
-                continue
-
-            if os.path.exists(mouse_data):
-                name, desc, weight = parse_mousedata(mouse_data)
-                to_process[os.path.join(folder, "unitME", sess)] = {
-                    "session_description": desc,
-                    "mouse_name": name,
-                    "mouse_weight": weight
-                }
-            else:
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        sessions = []
+        for folder_sessions in executor.map(lambda folder: _scan_date_folder(root_path, folder), folders):
+            for folder, sess in folder_sessions:
+                if sess is None:
+                    print(f"No unitME folder in '{folder}', Skipping")
+                else:
+                    sessions.append((folder, sess))
+
+        scanned = executor.map(lambda fs: _scan_session_folder(root_path, *fs), sessions)
+        for (folder, sess), (nwbs, inputs, mousedata) in zip(sessions, scanned):
+            session_id = os.path.join(folder, "unitME", sess)
+            if mousedata is None:
+                if nwbs and SKIP_EXISTING:
+                    print(f"Already found NWB in folder {folder}/{sess}, Skipping")
+                    continue
                 print(f"mousedata.txt not found in folder '{folder}/{sess}'")
                 failed_mousedata.append(f"{folder}/{sess}")
+                continue
+
+            name, desc, weight = mousedata
+            session_data = {
+                "session_description": desc,
+                "mouse_name": name,
+                "mouse_weight": weight,
+                "input_fingerprints": inputs
+            }
+            if SKIP_EXISTING:
+                if nwbs and not manifest.is_recorded(session_id):
+                    # Converted before there was a manifest, trust it's up to date with the files as they are now
+                    print(f"Already found NWB in folder {folder}/{sess}, recording it as up to date, Skipping")
+                    manifest.record(session_id, inputs, session_params(session_data), nwbs)
+                    continue
+                reason = manifest.needs_rebuild(session_id, inputs, session_params(session_data))
+                if reason is None:
+                    print(f"NWB in folder {folder}/{sess} is up to date, Skipping")
+                    continue
+                if nwbs:
+                    print(f"Reconverting folder {folder}/{sess}, {reason}")
+
+            to_process[session_id] = session_data
 
     return to_process, failed_mousedata
 
 
-def main():
+def _record_converted(manifest, prefix, session_id, session_data, nwb_filename):
+    manifest.record(
+        session_id,
+        session_data["input_fingerprints"],
+        session_params(session_data),
+        [os.path.join(prefix, session_id, nwb_filename)]
+    )
+
+
+def process_sessions_staged(prefix, sessions_to_process, workers, staging_dir, manifest):
+    # Copies session folders to staging_dir ahead of the workers, converts the local copy, then copies the new NWB
+    # back into the session folder in the background. Returns the list of (session_id, error) that failed
+    session_ids = {os.path.join(prefix, session_id): session_id for session_id in sessions_to_process.keys()}
+
+    def session_args(staged):
+        # Staged root has the same session_id layout as prefix
+        session_id = session_ids[staged.source]
+        session_data = sessions_to_process[session_id]
+        return staged.root, session_id, session_data["session_description"], session_data["mouse_name"], session_data["mouse_weight"]
+
+    def on_done(staged, nwb_filename):
+        session_id = session_ids[staged.source]
+        # If the write back fails the NWB is missing, so the manifest still has it reconverted next time
+        _record_converted(manifest, prefix, session_id, sessions_to_process[session_id], nwb_filename)
+        existing = set(os.listdir(staged.source))
+        return [
+            (os.path.join(staged.local, filename), os.path.join(staged.source, filename))
+            for filename in os.listdir(staged.local) if filename.endswith(".nwb") and filename not in existing
+        ]
+
+    print(f"Processing {len(sessions_to_process)} sessions with {workers} workers, staging in '{staging_dir}'")
+    # Only the files the converter reads are staged, existing NWBs never are and videos only when they're embedded
+    staging_ignore = shutil.ignore_patterns("*.nwb") if EMBED_VIDEOS else shutil.ignore_patterns("*.nwb", "*.mp4")
+    with StagingCache(list(session_ids.items()), staging_dir, STAGING_PREFETCH, STAGING_MAX_BYTES, ignore=staging_ignore) as stager:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errored = submit_staged(stager, executor, workers, process_session, session_args, on_done)
+
+    return [(session_ids[source], err) for source, err in errored] + stager.write_errors
+
+
+def main(workers=1, staging_dir=None):
     # prefix = "E:\\AnneData"
     prefix = "/media/polegpolskylab/VIDEO-DATA-02/CompressedDataLocal/"
 
-    sessions_to_process, failed_mousedata = mass_process_sessions(prefix)
+    manifest = BuildManifest(os.path.join(prefix, MANIFEST_FILENAME))
+    sessions_to_process, failed_mousedata = mass_process_sessions(prefix, manifest)
 
     errored_sessions = []
     # import time
     # print("Waiting 5 seconds to start")
     # time.sleep(5)
 
-    for session_id, session_data in sessions_to_process.items():
-        print(f"Processing session '{session_id}'")
-        try:
-            process_session(
-                prefix,
-                session_id,
-                session_data["session_description"],
-                session_data["mouse_name"],
-                session_data["mouse_weight"]
-            )
-        except Exception as e:
-            errored_sessions.append((session_id, e))
-            print(f"ERROR WITH SESSION {session_id}! ABORTING! Error: {str(e)}")
-            # raise e
+    if staging_dir is not None:
+        errored_sessions = process_sessions_staged(prefix, sessions_to_process, workers, staging_dir, manifest)
+    elif workers > 1:
+        print(f"Processing {len(sessions_to_process)} sessions with {workers} workers")
+        finished = []
+
+        def on_done(args, nwb_filename, err):
+            session_id = args[1]
+            finished.append(session_id)
+            if err is None:
+                _record_converted(manifest, prefix, session_id, sessions_to_process[session_id], nwb_filename)
+                print(f"[{len(finished)}/{len(sessions_to_process)}] Finished session '{session_id}'")
+            else:
+                errored_sessions.append((session_id, err))
+                print(f"[{len(finished)}/{len(sessions_to_process)}] ERROR WITH SESSION {session_id}! Error: {err}")
+
+        jobs = [
+            (prefix, session_id, session_data["session_description"], session_data["mouse_name"], session_data["mouse_weight"])
+            for session_id, session_data in sessions_to_process.items()
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            run_pooled(executor, process_session, jobs, on_done)
+    else:
+        for session_id, session_data in sessions_to_process.items():
+            print(f"Processing session '{session_id}'")
+            try:
+                nwb_filename = process_session(
+                    prefix,
+                    session_id,
+                    session_data["session_description"],
+                    session_data["mouse_name"],
+                    session_data["mouse_weight"]
+                )
+                _record_converted(manifest, prefix, session_id, session_data, nwb_filename)
+            except Exception as e:
+                errored_sessions.append((session_id, e))
+                print(f"ERROR WITH SESSION {session_id}! ABORTING! Error: {str(e)}")
+                # raise e
+
+    manifest.save()
 
     print("\nList of erroring sessions \n ------")
     for sid, err in errored_sessions:
@@ -519,6 +678,19 @@ def main():
         print(m)
     print("")
 
+    print("Summary \n ------")
+    print(f"Converted: {len(sessions_to_process) - len(errored_sessions)}/{len(sessions_to_process)}")
+    print(f"Errored: {len(errored_sessions)}")
+    print(f"Missing mousedata.txt: {len(failed_mousedata)}")
+
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(
+        prog="raw_to_rawnwb.py",
+        description="Converts raw session folders into NWB files"
+    )
+    arg_parser.add_argument("-w", "--workers", type=int, default=1, help="Number of sessions to convert in parallel")
+    arg_parser.add_argument("-s", "--staging-dir", default=None, help="Local folder to copy session folders into before converting them")
+    args = arg_parser.parse_args()
+
+    main(workers=args.workers, staging_dir=args.staging_dir)
@@ -1,6 +1,8 @@
+import argparse
 import glob
 import os
-import uuid
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import pendulum
 from pynwb import NWBHDF5IO
@@ -9,6 +11,18 @@ from simply_nwb import SimpleNWB
 from simply_nwb.pipeline import NWBSession
 from simply_nwb.pipeline.enrichments.saccades import PutativeSaccadesEnrichment
 
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.manifest import BuildManifest, fingerprint_files
+from conversion_utils.pool import run_pooled
+from conversion_utils.staging import StagingCache, submit_staged
+
+STAGING_DIR = "tmpdir"  # Local folder raw NWBs are copied into before being processed
+PREFETCH_COUNT = 2  # Number of raw NWBs to copy ahead of the workers
+STAGING_BUDGET_BYTES = 50 * 2 ** 30  # Max total size of staged copies on local disk
+MANIFEST_FILENAME = "manifest.json"  # Kept in the output folder, records which raw NWB each putative NWB was made from
+PUTATIVE_PARAMS = {"enrichment": "PutativeSaccadesEnrichment", "version": 1}  # Bump the version to regenerate everything
+
 
 def search_for_data(prefix):
     print(f"Found {len(os.listdir(prefix))} files in {prefix}")
@@ -21,22 +35,37 @@ def search_for_data(prefix):
     return datafiles
 
 
-def process_folder(nwbfilename, outputdir):
-    print(f"Processing '{nwbfilename}'")
+def putative_savename(nwbfilename, outputdir):
     save_fn = os.path.basename(nwbfilename)[:-len(".nwb")]  # Remove .nwb and truncate path
-    savename = os.path.join(outputdir, f"{save_fn}_putative.nwb")
-    if os.path.exists(savename):
-        print(f"File {savename} exists, skipping. Delete to re-generate..")
-        return
-    tmp_dir = os.path.join("tmpdir", str(uuid.uuid4()))
-
-    if not os.path.exists("tmpdir"):
-        os.mkdir("tmpdir")
-
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
+    return os.path.join(outputdir, f"{save_fn}_putative.nwb")
+
+
+def select_outdated(datafiles, outputdir, manifest):
+    # Raw NWBs whose putative NWB is missing or was made from a different version of them, with the input fingerprints
+    # to record once they're done
+    todo = []
+    for nwbfilename in datafiles:
+        savename = putative_savename(nwbfilename, outputdir)
+        inputs = fingerprint_files([nwbfilename])
+        if os.path.exists(savename) and not manifest.is_recorded(savename):
+            # Made before there was a manifest, trust it's up to date with the raw NWB as it is now
+            manifest.record(savename, inputs, PUTATIVE_PARAMS, [savename])
+            continue
+        reason = manifest.needs_rebuild(savename, inputs, PUTATIVE_PARAMS)
+        if reason is None:
+            continue
+        if os.path.exists(savename):
+            print(f"Regenerating {savename}, {reason}")
+        todo.append((nwbfilename, inputs))
+    return todo
+
+
+def process_folder(nwbfilename, outputdir, staged_filename=None):
+    # If staged_filename is given, it's a local copy of nwbfilename to read from instead
+    print(f"Processing '{nwbfilename}'")
+    savename = putative_savename(nwbfilename, outputdir)
 
-    sess = NWBSession(os.path.join(nwbfilename))
+    sess = NWBSession(staged_filename or nwbfilename)
     enrichment = PutativeSaccadesEnrichment()
     sess.enrich(enrichment)
 
@@ -44,7 +73,58 @@ def process_folder(nwbfilename, outputdir):
     del sess
 
 
-def main():
+def _write_error(filename, err):
+    print(f"Error '{err}'")
+    with open(os.path.basename(filename) + "-error.txt", "w") as f:
+        f.write(str(err))
+
+
+def process_staged(todo, outputdir, workers, prefetch_count, budget_bytes, manifest):
+    # Stage upcoming files to local disk in the background while a pool of workers processes the ones already staged
+    # todo is a list of (filename, input fingerprints). Returns the list of (filename, error) that failed
+    inputs = dict(todo)
+
+    def on_done(staged, result):
+        # Putative NWB is saved straight to outputdir, nothing to write back
+        savename = putative_savename(staged.source, outputdir)
+        manifest.record(savename, inputs[staged.source], PUTATIVE_PARAMS, [savename])
+        return []
+
+    with StagingCache(list(inputs.keys()), STAGING_DIR, prefetch_count, budget_bytes) as stager:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errored = submit_staged(
+                stager, executor, workers, process_folder,
+                lambda staged: (staged.source, outputdir, staged.local),
+                on_done
+            )
+
+    for filename, err in errored:
+        _write_error(filename, err)
+    return errored
+
+
+def process_pooled(todo, outputdir, workers, manifest):
+    # Process files straight from the share with a pool of workers, no staging
+    # todo is a list of (filename, input fingerprints). Returns the list of (filename, error) that failed
+    errored = []
+    inputs = dict(todo)
+
+    def on_done(args, result, err):
+        filename, _ = args
+        if err is not None:
+            errored.append((filename, err))
+            _write_error(filename, err)
+        else:
+            savename = putative_savename(filename, outputdir)
+            manifest.record(savename, inputs[filename], PUTATIVE_PARAMS, [savename])
+            print(f"Finished '{filename}'")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        run_pooled(executor, process_folder, [(filename, outputdir) for filename in inputs.keys()], on_done)
+    return errored
+
+
+def main(workers=1, prefetch_count=PREFETCH_COUNT, budget_bytes=STAGING_BUDGET_BYTES):
     prefix = "/run/user/1000/gvfs/smb-share:server=felsenlabnas.local,share=felsennasfolder/AnneData/raw_nwbs_unzipped"  # TODO Change me to dir of sessions
     outputdir = "putative_output"
 
@@ -52,17 +132,41 @@ def main():
     if not os.path.exists(outputdir):
         os.mkdir(outputdir)
 
-    for filename in datafiles:
-        try:
-            process_folder(filename, outputdir)
-        except Exception as e:
-            print(f"Error '{e}'")
-            with open(os.path.basename(filename) + "-error.txt", "w") as f:
-                f.write(str(e))
+    with BuildManifest(os.path.join(outputdir, MANIFEST_FILENAME)) as manifest:
+        # Skip files that are already done before staging them, so nothing gets copied for no reason
+        todo = select_outdated(datafiles, outputdir, manifest)
+        print(f"Skipping {len(datafiles) - len(todo)} files that already have an up to date putative NWB")
+
+        if prefetch_count > 0:
+            errored = process_staged(todo, outputdir, workers, prefetch_count, budget_bytes, manifest)
+        elif workers > 1:
+            errored = process_pooled(todo, outputdir, workers, manifest)
+        else:
+            errored = []
+            for filename, inputs in todo:
+                try:
+                    process_folder(filename, outputdir)
+                    savename = putative_savename(filename, outputdir)
+                    manifest.record(savename, inputs, PUTATIVE_PARAMS, [savename])
+                except Exception as e:
+                    errored.append((filename, e))
+                    _write_error(filename, e)
+
+        print("Summary \n ------")
+        print(f"Processed: {len(todo) - len(errored)}/{len(todo)}")
+        print(f"Errored: {len(errored)}")
 
     tw = 2
 
 
 if __name__ == "__main__":
-    main()
-
+    arg_parser = argparse.ArgumentParser(
+        prog="rawnwb_to_putative.py",
+        description="Runs putative saccade detection on raw NWB files"
+    )
+    arg_parser.add_argument("-w", "--workers", type=int, default=1, help="Number of files to process in parallel")
+    arg_parser.add_argument("-k", "--prefetch", type=int, default=PREFETCH_COUNT, help="Number of files to copy to local disk ahead of the workers, 0 reads straight from the share")
+    arg_parser.add_argument("--staging-budget-gb", type=float, default=STAGING_BUDGET_BYTES / 2 ** 30, help="Max size of staged copies on local disk")
+    args = arg_parser.parse_args()
+
+    main(workers=args.workers, prefetch_count=args.prefetch, budget_bytes=int(args.staging_budget_gb * 2 ** 30))
@@ -1,5 +1,5 @@
 from pynwb.behavior import BehavioralEvents
-from simply_nwb.transforms import labjack_load_file, mp4_read_data
+from simply_nwb.transforms import mp4_read_data
 from simply_nwb import SimpleNWB
 from simply_nwb.transforms import plaintext_metadata_read
 from simply_nwb.util import panda_df_to_list_of_timeseries, dict_to_dyn_tables, create_mouse_subject
@@ -9,10 +9,15 @@ import pendulum
 import glob
 import pickle
 import os
+import sys
 import h5py
-import numpy as np
 from pathlib import Path
-import pandas as pd
+
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.ephys import load_spike_data, iter_cluster_spike_times
+from conversion_utils.video import mp4_add_as_streamed_acquisition
+from conversion_utils.labjack import labjack_load_files
 
 # Simply-NWB Package Documentation
 # https://simply-nwb.readthedocs.io/en/latest/index.html
@@ -58,6 +63,8 @@ MP4_FILES = [
 ]
 
 MP4_SAMPLING_RATE = 200.0
+MP4_STREAMING = False  # If true, decode and write videos in chunks instead of reading the whole video into memory
+MP4_BUFFER_FRAMES = 200  # Number of frames held in memory at once when streaming
 
 
 def process_mp4_data(nwbfile, session_path):
@@ -69,6 +76,17 @@ def process_mp4_data(nwbfile, session_path):
         if not files:
             raise ValueError(f"Couldn't find file with glob '{mp4_file_glob}'")
 
+        if MP4_STREAMING:
+            mp4_add_as_streamed_acquisition(
+                nwbfile,
+                name=mp4_name,
+                filename=files[0],
+                sampling_rate=MP4_SAMPLING_RATE,
+                description=mp4_desc,
+                buffer_frames=MP4_BUFFER_FRAMES
+            )
+            continue
+
         data, frames = mp4_read_data(files[0])
         SimpleNWB.mp4_add_as_acquisition(
             nwbfile,
@@ -85,18 +103,7 @@ def process_labjack_data(nwbfile, session_path):
     labjack_folder = os.path.join(session_path, "labjack/")
 
     labjack_files = glob.glob(os.path.join(labjack_folder, "*.dat"))
-    labjack_datas = []
-    for filename in labjack_files:
-        # print(f"Processing {filename}")
-        try:
-            labjack_datas.append(labjack_load_file(filename)["data"])
-        except Exception as e:
-            print(f"Failed parsing {filename}, Error '{str(e)}'skipping..")
-            continue
-    if not labjack_datas:
-        raise ValueError("Labjack data is empty! Cannot continue")
-
-    labjack_combined = pd.concat(labjack_datas)
+    labjack_combined = labjack_load_files(labjack_files)
 
     timeseries_list = panda_df_to_list_of_timeseries(
         pd_df=labjack_combined,
@@ -126,12 +133,9 @@ def process_ephys_data(nwbfile, session_path):
     except StopIteration:
         raise ValueError("Unable to find spike_times.npy!")
 
-    spike_cluster_data = np.load(str(spike_cluster_filename))
-    spike_time_data = np.load(str(spike_times_filename))
+    spike_cluster_data, spike_time_data = load_spike_data(spike_cluster_filename, spike_times_filename)
 
-    for cluster_number in np.unique(spike_cluster_data):
-        spike_time_indices_for_cluster = np.where(spike_cluster_data == cluster_number)[0]
-        spike_times_for_cluster = spike_time_data[spike_time_indices_for_cluster].flatten()
+    for cluster_number, spike_times_for_cluster in iter_cluster_spike_times(spike_cluster_data, spike_time_data):
         nwbfile.add_unit(spike_times=spike_times_for_cluster)
 
     nwbfile.create_device(
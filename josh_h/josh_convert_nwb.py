@@ -1,5 +1,5 @@
 from pynwb.behavior import BehavioralEvents
-from simply_nwb.transforms import labjack_load_file, mp4_read_data
+from simply_nwb.transforms import mp4_read_data
 from simply_nwb import SimpleNWB
 from simply_nwb.transforms import plaintext_metadata_read
 from simply_nwb.util import panda_df_to_list_of_timeseries, dict_to_dyn_tables
@@ -9,10 +9,17 @@ import pendulum
 import glob
 import pickle
 import os
+import sys
 import h5py
 import numpy as np
 from pathlib import Path
-import pandas as pd
+
+# Shared helpers are in conversion_utils/ at the root of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion_utils.stim_metadata import parse_metadata_file
+from conversion_utils.ephys import load_spike_data, iter_cluster_spike_times
+from conversion_utils.video import mp4_add_as_streamed_acquisition
+from conversion_utils.labjack import labjack_load_files
 
 # Simply-NWB Package Documentation
 # https://simply-nwb.readthedocs.io/en/latest/index.html
@@ -66,6 +73,8 @@ MP4_FILES = {
 }
 MP4_DESCRIPTION = "TODO"  # TODO Change me
 MP4_SAMPLING_RATE = 200.0
+MP4_STREAMING = False  # If true, decode and write videos in chunks instead of reading the whole video into memory
+MP4_BUFFER_FRAMES = 200  # Number of frames held in memory at once when streaming
 
 # TODO
 # Do we need to include this file? I don't have a copy and there is no code for importing this yet
@@ -85,18 +94,7 @@ def process_labjack_data(nwbfile, session_path):
     labjack_folder = os.path.join(session_path, LABJACK_FOLDER)
 
     labjack_files = glob.glob(os.path.join(labjack_folder, "*.dat"))
-    labjack_datas = []
-    for filename in labjack_files:
-        # print(f"Processing {filename}")
-        try:
-            labjack_datas.append(labjack_load_file(filename)["data"])
-        except Exception as e:
-            print(f"Failed parsing {filename}, Error '{str(e)}'skipping..")
-            continue
-    if not labjack_datas:
-        raise ValueError("Labjack data is empty! Cannot continue")
-
-    labjack_combined = pd.concat(labjack_datas)
+    labjack_combined = labjack_load_files(labjack_files)
 
     timeseries_list = panda_df_to_list_of_timeseries(
         pd_df=labjack_combined,
@@ -118,76 +116,8 @@ def process_labjack_data(nwbfile, session_path):
 def process_stimulus_metadata(nwbfile, session_path, stim_filename, stim_name):
     filename = os.path.join(session_path, stim_filename)
 
-    fp = open(filename, "r")
-    processed = {}
-
-    ###########################
-    # Parsing code, can ignore
-    ###########################
-    data = fp.readlines()
-    # Parse Header
-    file_line_idx = 0
-    while True:
-        line = data[file_line_idx]
-        if line.startswith("------------"):
-            break
-        sep_idx = line.find(":")
-        key = line[:sep_idx].strip()
-        val = line[sep_idx + 1:].strip()
-        processed[key] = "Meta" + val  # prepend meta to ensure no collisions
-        file_line_idx = file_line_idx + 1
-    if "Columns" not in processed:
-        raise ValueError("Could not process driftingGratingMetadata.txt, couldn't find Column names")
-
-    cols = []
-    cols_str = processed["Columns"]
-    starting_idx = 0
-    range_len = 0
-    str_idx = 0
-    while True:
-        char = cols_str[str_idx]
-        if char == "(":
-            while True:
-                str_idx = str_idx + 1
-                range_len = range_len + 1
-                if cols_str[str_idx] == ")":
-                    break
-                if str_idx == 10000:
-                    raise ValueError("String didn't have a terminating ')'! (or too long)")
-            str_idx = str_idx + 1  # Increment past the ')'
-            range_len = range_len + 1
-            if str_idx >= len(cols_str):  # ) is the end of the string
-                char = ""
-            else:
-                char = cols_str[str_idx]
-
-        if char == "," or str_idx + 1 >= len(cols_str):
-            cols.append(cols_str[starting_idx:starting_idx + range_len])
-            starting_idx = str_idx + 1
-            range_len = 0
-            if str_idx + 1 >= len(cols_str):
-                break
-        range_len = range_len + 1
-        str_idx = str_idx + 1
-
-    # Clean up the header strings by removing whitespace and removing trailing ','
-    cols = [c.strip() for c in cols]
-    cols = [c[:-1] if c.endswith(",") else c for c in cols]
-
-    file_line_idx = file_line_idx + 1
-    drift_data = data[file_line_idx:]
-
-    processed.update({c: [] for c in cols})
-
-    for drift_line in drift_data:
-        split = drift_line.split(",")
-        if len(split) != len(cols):
-            raise ValueError(f"Invalid number of columns for line '{split}' Doesnt match up with expected columns")
-        for col_idx, col in enumerate(cols):
-            processed[col].append(float(split[col_idx].strip()))
-    ##################
-    # End parsing code
-    ##################
+    processed = parse_metadata_file(filename)
+
     desc = "Metadata for the stimulus '{}'".format(stim_name)
     SimpleNWB.add_to_processing_module(nwbfile, dict_to_dyn_tables(processed, stim_name, desc), "stim_metadata", desc)
 
@@ -234,12 +164,9 @@ def process_ephys_data(nwbfile, session_path):
     except StopIteration:
         raise ValueError("Unable to find spike_times.npy!")
 
-    spike_cluster_data = np.load(str(spike_cluster_filename))
-    spike_time_data = np.load(str(spike_times_filename))
+    spike_cluster_data, spike_time_data = load_spike_data(spike_cluster_filename, spike_times_filename)
 
-    for cluster_number in np.unique(spike_cluster_data):
-        spike_time_indices_for_cluster = np.where(spike_cluster_data == cluster_number)[0]
-        spike_times_for_cluster = spike_time_data[spike_time_indices_for_cluster].flatten()
+    for cluster_number, spike_times_for_cluster in iter_cluster_spike_times(spike_cluster_data, spike_time_data):
         nwbfile.add_unit(spike_times=spike_times_for_cluster)
 
     nwbfile.create_device(
@@ -309,6 +236,17 @@ def process_session(session_path, session_id):
         if not files:
             raise ValueError(f"Couldn't find file with glob '{mp4_file_glob}'")
 
+        if MP4_STREAMING:
+            mp4_add_as_streamed_acquisition(
+                nwbfile,
+                name=mp4_name,
+                filename=files[0],
+                sampling_rate=MP4_SAMPLING_RATE,
+                description=MP4_DESCRIPTION,
+                buffer_frames=MP4_BUFFER_FRAMES
+            )
+            continue
+
         data, frames = mp4_read_data(files[0])
         SimpleNWB.mp4_add_as_acquisition(
             nwbfile,
@@ -2,7 +2,8 @@ import h5py
 import numpy as np
 from dict_plus.utils import SimpleFlattener
 from hdmf.backends.hdf5 import H5DataIO
-from hdmf.common import DynamicTable, VectorData
+from hdmf.common import DynamicTable, VectorData, VectorIndex
+from hdmf.data_utils import GenericDataChunkIterator
 from simply_nwb.transforms import labjack_load_file, mp4_read_data
 from simply_nwb import SimpleNWB
 from simply_nwb.transforms import plaintext_metadata_read
@@ -17,14 +18,42 @@ from simply_nwb.util import dict_to_dyn_tables
 # Simply-NWB Package Documentation
 # https://simply-nwb.readthedocs.io/en/latest/index.html
 
+RAGGED_SWEEP_DATA = False  # If true, store sweep data as (data, index) ragged columns instead of padding with NaN
+
+
+class H5DatasetChunkIterator(GenericDataChunkIterator):
+    # Reads a source h5py.Dataset a chunk at a time while the NWB is being written
+    def __init__(self, dataset, **kwargs):
+        self.dataset = dataset
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        return self.dataset[selection]
+
+    def _get_maxshape(self):
+        return self.dataset.shape
+
+    def _get_dtype(self):
+        return self.dataset.dtype
+
+
+def lazy_dataset(dataset):
+    # Wrap a source dataset so it's streamed into the NWB when writing instead of being read into memory up front
+    if dataset.shape == ():
+        return np.array([dataset[()]])
+    if dataset.size == 0 or dataset.dtype.kind not in "biuf":
+        return dataset[:]  # Empty and string datasets are small metadata, read them directly
+    return H5DataIO(data=H5DatasetChunkIterator(dataset), compression=True)
+
+
+def dataset_row_ids(dataset):
+    # Row ids for a DynamicTable with a lazy_dataset column, hdmf can't count the rows of a streamed column itself
+    return list(range(1 if dataset.shape == () else dataset.shape[0]))
+
 
 def dictify_hd5(data):
     if isinstance(data, h5py.Dataset):
-        try:
-            return list(data[:])
-        except Exception as e:
-            print(f"Errorrrrrr {str(e)}")
-            return "BROKEN!!!!!!!!!!!!!!!!!!!!!!"
+        return data  # Leave as a handle, the data is read when it's written
     else:
         dd = dict(data)
         d = {}
@@ -109,7 +138,7 @@ def traverse_hdf5(name, entry):
     result = []
     if isinstance(entry, h5py._hl.dataset.Dataset):
         if entry.shape != ():
-            result.append((name, entry[:]))
+            result.append((name, entry))  # Only the handle, grouping just needs the shape
     else:
         leafs = {}
         for entry_k, entry_v in entry.items():
@@ -139,55 +168,54 @@ def fix(val, index=0, backup=None):
             raise e
 
 
-def fill_data(listdata):
-    # Takes a list of numpy arrays and fills them so that all arrays are the same dimensions, but fills with NaN values
-    # listdata = [arr1, ..]
-    largest_dim_lens = []
-    for v in listdata:
-        if v is not None:
-            # Find the largest dimension among all the list entries
-            if len(largest_dim_lens) < len(v.shape):
-                [largest_dim_lens.append(0) for _ in
-                 range(len(v.shape) - len(largest_dim_lens))]  # Add new dimension maxes
-            for idx, dim in enumerate(v.shape):
-                if largest_dim_lens[idx] < dim:
-                    largest_dim_lens[idx] = dim
-
-    fill = np.ma.masked
-    if listdata[0] is None:  # Can't fill empty values, return nothing
-        return np.array([[]])
-
-    if isinstance(listdata[0][0], (bytes, str)):
-        fill = None
-
-    dtype = listdata[0][:].dtype
-    if listdata[0][:].dtype == object:
-        dtype = object
-
-    new_listdata = np.empty([len(listdata), *largest_dim_lens], dtype=dtype)
-    new_listdata[:] = fill
+def _fill_value(dtype):
+    # Value to fill missing entries with, NaN for numbers and empty values for anything else
+    if dtype.kind in "fc":
+        return np.nan
+    if dtype.kind in "SU":
+        return ""
+    return None
 
-    for idx, l in enumerate(listdata):
-        if l is None:
-            continue
-        l = l[:]
-        l_shape = []
 
-        if len(l.shape) < len(largest_dim_lens):
-            for _ in range(len(largest_dim_lens) - len(l.shape)):
-                l = l[..., None]
+def fill_data(listdata, ragged=False):
+    # Takes a list of numpy arrays (or h5py datasets) and fills them so that all arrays are the same dimensions,
+    # missing values are filled with NaN (or empty values for non-numeric data)
+    # If ragged is True, returns (data, index) instead where the arrays are concatenated along the first axis and
+    # index[i] is the end of entry i in data, like a VectorIndex. Only works if all arrays share their other dimensions
+    # listdata = [arr1, ..]
+    present = [(idx, v) for idx, v in enumerate(listdata) if v is not None]
+    if not present:  # Can't fill empty values, return nothing
+        return np.array([[]])
 
-        for lsh_idx, lsh in enumerate(largest_dim_lens):
-            if len(l.shape) <= lsh_idx:
-                l_shape.append(0)
-            else:
-                l_shape.append(l.shape[lsh_idx])
+    # Find the largest dimensions among all the list entries, only needs the shapes so datasets aren't read yet
+    ndim = max([1, *[len(v.shape) for _, v in present]])
+    shapes = np.array([(*v.shape, *([1] * (ndim - len(v.shape)))) for _, v in present])
+    largest_dim_lens = shapes.max(axis=0)
 
-        new_listdata[idx, :] = np.pad(
-            l,
-            [(0, largest_dim_lens[i] - l_shape[i]) for i in range(len(largest_dim_lens))],
-            constant_values=fill
-        )
+    try:
+        dtype = np.result_type(*[v.dtype for _, v in present])
+    except TypeError:
+        dtype = np.dtype(object)  # Mixed types, can't use a single numeric or string type
+    if ragged:
+        if len({tuple(shp[1:]) for shp in shapes}) != 1:
+            raise ValueError("Cannot create ragged array, entries have different trailing dimensions")
+        lengths = np.zeros(len(listdata), dtype=np.int64)
+        lengths[[idx for idx, _ in present]] = shapes[:, 0]
+        index = np.cumsum(lengths)
+        data = np.empty((index[-1], *largest_dim_lens[1:]), dtype=dtype)
+        for (idx, v), shp in zip(present, shapes):
+            data[index[idx] - lengths[idx]:index[idx]] = np.asarray(v[()]).reshape(shp)
+        return data, index
+
+    if dtype.kind in "biu":
+        # Integers can't hold NaN, float32 holds up to 16-bit integers (ie uint16 two photon/ADC data) exactly
+        dtype = np.dtype(np.float32 if dtype.itemsize <= 2 else np.float64)
+    fill = _fill_value(dtype)
+
+    new_listdata = np.full([len(listdata), *largest_dim_lens], fill, dtype=dtype)
+    for (idx, v), shp in zip(present, shapes):
+        # Read and copy each entry straight into its corner of the array
+        new_listdata[(idx, *[slice(0, dim) for dim in shp])] = np.asarray(v[()]).reshape(shp)
     return new_listdata
 
 
@@ -197,6 +225,7 @@ def process_analysis_events(nwbfile, data):
         event = data["events"][event_name]
         result = traverse_hdf5(event_name, event)
         for prefix, event_data in result:
+            event_data = {k: v[:] for k, v in event_data.items()}  # Read only the group being added
             uneven = False
             event_items = list(event_data.items())
             if len(event_items) > 1:
@@ -233,7 +262,7 @@ def process_analysis_traces(nwbfile, data):
     for subkey in all_keys:
         if subkey == "events":
             continue
-        flattened = {k: v[:] for k, v in fl.flatten(data[subkey]).items()}  # Convert to numpy array
+        flattened = fl.flatten(data[subkey])  # Dataset handles, streamed from the source file on write
 
         for k, v in flattened.items():
             SimpleNWB.add_to_processing_module(
@@ -241,13 +270,10 @@ def process_analysis_traces(nwbfile, data):
                 DynamicTable(
                     name=k,
                     description="Analysis Traces",
+                    id=dataset_row_ids(v),
                     columns=[VectorData(
                         name=k,
-                        data=H5DataIO(
-                            data=v,
-                            compression=True,
-                            chunks=True
-                        ),
+                        data=lazy_dataset(v),
                         description="Analysis Traces"
                     )]
                 ), f"analysis_{subkey}", f"Analysis for {subkey}")
@@ -341,8 +367,16 @@ def process_data(nwbfile, d):
     # NWB doesn't like bytes as strings
     two_photon_data = [(v or [b''])[:][0].decode("utf-8") for v in sweep_data.pop(two_photon)]
 
+    def pack(listdata):
+        if RAGGED_SWEEP_DATA:
+            try:
+                return fill_data(listdata, ragged=True)
+            except ValueError:
+                pass  # Can't be stored ragged, pad instead
+        return fill_data(listdata)
+
     print("Resizing arrays, might take a minute..")
-    sweep_data = {get_name(k): fill_data(v) for k, v in sweep_data.items()}
+    sweep_data = {get_name(k): pack(v) for k, v in sweep_data.items()}
     sweep_data["filedata"] = sweep_data.pop(get_name("filedata"))
 
     sweep_data[get_name(two_photon)] = two_photon_data
@@ -350,20 +384,28 @@ def process_data(nwbfile, d):
         sweep_data[f] = tmp.pop(f)
     print("Writing data to NWB file and compressing..")
     for k, v in sweep_data.items():
+        index = None
+        if isinstance(v, tuple):  # Ragged (data, index)
+            v, index = v
+
+        columns = [VectorData(
+            name=k,
+            data=H5DataIO(
+                data=v,
+                compression=True,
+                chunks=True
+            ),
+            description="Sweep data"
+        )]
+        if index is not None:
+            columns.append(VectorIndex(name=f"{k}_index", data=index, target=columns[0]))
+
         SimpleNWB.add_to_processing_module(
             nwbfile,
             DynamicTable(
                 name=f"data_{k}",
                 description="Sweep data",
-                columns=[VectorData(
-                    name=k,
-                    data=H5DataIO(
-                        data=v,
-                        compression=True,
-                        chunks=True
-                    ),
-                    description="Sweep data"
-                )]
+                columns=columns
             ), "data", "Sweep data")
 
 
@@ -419,7 +461,6 @@ def process_events(nwbfile, data):
 
 def process_general(nwbfile, d):
     data = dictify_hd5(d["general"])
-    data = {k: np.array(v) for k, v in data.items()}
 
     for k, v in data.items():
         SimpleNWB.add_to_processing_module(
@@ -427,9 +468,10 @@ def process_general(nwbfile, d):
             DynamicTable(
                 name=k,
                 description="General Information",
+                id=dataset_row_ids(v),
                 columns=[VectorData(
                     name=k,
-                    data=v,
+                    data=lazy_dataset(v),
                     description="General Information"
                 )]
             ), "general", "General Information")